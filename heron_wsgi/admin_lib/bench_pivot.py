@@ -0,0 +1,121 @@
+'''bench_pivot -- compare redcap_data unpivot strategies
+
+Usage:
+
+  python bench_pivot.py [DB_URL [RECORDS [FIELDS...]]]
+
+DB_URL defaults to an in-memory sqlite database. With MySQL, use an
+empty scratch database: the redcap_data table is created and filled
+with synthetic EAV data for several projects, as in a real REDCap
+database, and one of them is unpivoted.
+
+The strategies find the same rows, whether the project is given to
+unpivot() or picked out of its result afterward::
+
+  >>> engine = _test_engine()
+  >>> load(engine, project_id=1, records=20, fields=6)
+  119
+  >>> load(engine, project_id=2, records=5, fields=6)
+  29
+  >>> rows = dict(((aggregate, inside),
+  ...              sorted(pivot(engine, 1, 6, aggregate, inside)))
+  ...             for aggregate in (False, True)
+  ...             for inside in (False, True))
+  >>> len(set(tuple(map(tuple, r)) for r in rows.values()))
+  1
+  >>> len(rows[True, True])
+  19
+  >>> rows[True, True][0]
+  (1, u'1', u'v_1_0', u'v_1_1', u'v_1_2', u'v_1_3', u'v_1_4', u'v_1_5')
+
+'''
+
+from __future__ import print_function
+import time
+
+from sqlalchemy import create_engine
+
+import redcapdb
+from sqlite_mem import _test_engine
+
+
+def field_names(fields):
+    return ['f_%d' % ix for ix in range(fields)]
+
+
+def load(engine, project_id, records, fields, event_id=1):
+    '''Fill redcap_data with synthetic records; each has all fields,
+    except the last record lacks one.
+
+    :return: number of rows inserted
+    '''
+    redcap_data = redcapdb.redcap_data
+    if not engine.dialect.has_table(engine, redcap_data.name):
+        redcap_data.create(engine)
+        # REDCap indexes redcap_data this way too.
+        engine.execute('create index bench_record_field'
+                       ' on redcap_data (record, field_name)')
+    names = field_names(fields)
+    rows = [dict(project_id=project_id, event_id=event_id,
+                 record=str(record), field_name=name,
+                 value='v_%d_%d' % (record, ix))
+            for record in range(1, records + 1)
+            for ix, name in enumerate(names)
+            if record < records or ix > 0]
+    with engine.begin() as conn:
+        conn.execute(redcap_data.insert(), rows)
+    return len(rows)
+
+
+def pivot(engine, project_id, fields, aggregate, inside=True):
+    '''Unpivot one project's records.
+
+    :param inside: give project_id to unpivot() rather than filter
+                   its result
+    '''
+    cols, _, _, relation = redcapdb.unpivot(
+        field_names(fields), record=True, aggregate=aggregate,
+        project_id=project_id if inside else None)
+    q = relation.alias('pivot')
+    return engine.execute(q.select().where(
+        q.c.project_id == project_id)).fetchall()
+
+
+def timing(engine, project_id, fields, aggregate, inside=True, repeat=3):
+    best = None
+    for _ in range(repeat):
+        t0 = time.time()
+        pivot(engine, project_id, fields, aggregate, inside)
+        elapsed = time.time() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main(argv, projects=5):
+    url = argv[1] if len(argv) > 1 else None
+    records = int(argv[2]) if len(argv) > 2 else 2000
+    field_counts = [int(n) for n in argv[3:]] or [2, 8, 20, 60]
+
+    print('fields\tjoin\taggregate\tfiltered after'
+          '\t(sec, best of 3; %d records x %d projects)' %
+          (records, projects))
+    for run, fields in enumerate(field_counts):
+        engine = create_engine(url) if url else _test_engine()
+        project_ids = range(run * projects + 1, (run + 1) * projects + 1)
+        for project_id in project_ids:
+            load(engine, project_id, records, fields)
+        project_id = project_ids[0]
+        print('%d\t%.3f\t%.3f\t%.3f' % (
+            fields,
+            timing(engine, project_id, fields, aggregate=False),
+            timing(engine, project_id, fields, aggregate=True),
+            timing(engine, project_id, fields, aggregate=True,
+                   inside=False)))
+
+
+if __name__ == '__main__':  # pragma: nocover
+    def _script():
+        from sys import argv
+        main(argv)
+
+    _script()
@@ -0,0 +1,254 @@
+'''breaker -- fail fast while a remote service is down
+----------------------------------------------------
+
+A :class:`CircuitBreaker` lets calls through until `threshold` of
+them fail in a row::
+
+  >>> import rtconfig
+  >>> logged = rtconfig._printLogs()
+  >>> t = [0.0]
+  >>> cb = CircuitBreaker('db', threshold=2, reset_after=10,
+  ...                     clock=lambda: t[0], rng=lambda: 1.0)
+  >>> def down():
+  ...     raise IOError('connection refused')
+  >>> for attempt in range(2):
+  ...     try:
+  ...         cb.call(down)
+  ...     except IOError as oops:
+  ...         print(oops)
+  connection refused
+  connection refused
+
+Then it opens: calls fail right away, without bothering the service::
+
+  >>> print(logged())
+  WARNING:breaker:db: circuit open for 10.0 sec after 2 failures
+  >>> cb.state
+  'open'
+  >>> cb.call(lambda: 'ok')
+  Traceback (most recent call last):
+    ...
+  CircuitOpen: db: circuit open for 10.0 more sec
+
+After `reset_after` seconds, it is half-open: one call probes
+the service. If that fails, it stays open twice as long::
+
+  >>> t[0] = 10.0
+  >>> cb.state
+  'half_open'
+  >>> cb.call(down)
+  Traceback (most recent call last):
+    ...
+  IOError: connection refused
+  >>> cb.call(lambda: 'ok')
+  Traceback (most recent call last):
+    ...
+  CircuitOpen: db: circuit open for 20.0 more sec
+
+When a probe succeeds, the circuit closes::
+
+  >>> t[0] = 30.0
+  >>> cb.call(lambda: 'ok')
+  'ok'
+  >>> cb.state
+  'closed'
+  >>> print(logged())
+  WARNING:breaker:db: circuit open for 20.0 sec after 3 failures
+  INFO:breaker:db: circuit closed
+
+A probe that ends without an ordinary exception, say because the
+caller is interrupted or its greenlet is killed, doesn't keep others
+from probing::
+
+  >>> cb2 = CircuitBreaker('db2', threshold=1, reset_after=10,
+  ...                      clock=lambda: t[0], rng=lambda: 1.0)
+  >>> cb2.call(down)
+  Traceback (most recent call last):
+    ...
+  IOError: connection refused
+  >>> t[0] = 40.0
+  >>> class Interrupted(BaseException):
+  ...     pass
+  >>> def interrupted():
+  ...     raise Interrupted()
+  >>> cb2.call(interrupted)
+  Traceback (most recent call last):
+    ...
+  Interrupted
+  >>> cb2.call(lambda: 'ok')
+  'ok'
+  >>> _ = logged()
+
+Counts of what happened in each state are kept for monitoring::
+
+  >>> from pprint import pprint
+  >>> pprint(cb.snapshot())
+  {'closed': {'failed': 2, 'succeeded': 0},
+   'half_open': {'failed': 1, 'succeeded': 1},
+   'open': {'opened': 2, 'rejected': 2},
+   'state': 'closed'}
+
+'''
+
+import logging
+import random
+import threading
+import time
+
+import injector
+from sqlalchemy import event
+
+log = logging.getLogger(__name__)
+
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+
+class CircuitOpen(IOError):
+    pass
+
+
+class CircuitBreaker(object):
+    '''Stop calling a service that keeps failing; probe now and then.
+
+    :param threshold: consecutive failures before opening
+    :param reset_after: seconds to stay open at first; this doubles
+                        with each failed probe, up to `max_reset`
+    :param rng: source of jitter, so that processes don't all probe
+                at once; the open time is scaled by 0.5 to 1.0
+    '''
+    def __init__(self, name, threshold=5, reset_after=5, max_reset=300,
+                 clock=time.time, rng=random.random):
+        self.name = name
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self.max_reset = max_reset
+        self.__clock = clock
+        self.__rng = rng
+        self.__lock = threading.Lock()
+        self.__failures = 0
+        self.__trips = 0
+        self.__open_until = None
+        self.__probing = False
+        self.__counts = {CLOSED: dict(succeeded=0, failed=0),
+                         HALF_OPEN: dict(succeeded=0, failed=0),
+                         OPEN: dict(opened=0, rejected=0)}
+
+    @property
+    def state(self):
+        with self.__lock:
+            return self._state(self.__clock())
+
+    def _state(self, tnow):
+        if self.__open_until is None:
+            return CLOSED
+        return OPEN if tnow < self.__open_until else HALF_OPEN
+
+    def call(self, thunk):
+        with self.__lock:
+            tnow = self.__clock()
+            state = self._state(tnow)
+            if state == HALF_OPEN and self.__probing:
+                state = OPEN  # someone else is probing
+            if state == OPEN:
+                self.__counts[OPEN]['rejected'] += 1
+                raise CircuitOpen('%s: circuit open for %.1f more sec' % (
+                    self.name, max(self.__open_until - tnow, 0)))
+            if state == HALF_OPEN:
+                self.__probing = True
+        try:
+            result = thunk()
+        except Exception:
+            self._failed(state)
+            raise
+        else:
+            self._succeeded(state)
+            return result
+        finally:
+            # even if the probe was interrupted (KeyboardInterrupt, ...),
+            # let the next call probe
+            if state == HALF_OPEN:
+                with self.__lock:
+                    self.__probing = False
+
+    def _succeeded(self, state):
+        with self.__lock:
+            self.__counts[state]['succeeded'] += 1
+            if state == HALF_OPEN:
+                log.info('%s: circuit closed', self.name)
+            self.__failures = self.__trips = 0
+            self.__open_until = None
+
+    def _failed(self, state):
+        with self.__lock:
+            self.__counts[state]['failed'] += 1
+            self.__failures += 1
+            if state == HALF_OPEN or self.__failures >= self.threshold:
+                wait = min(self.max_reset,
+                           self.reset_after * 2 ** self.__trips) * (
+                               0.5 + self.__rng() / 2)
+                self.__trips += 1
+                self.__open_until = self.__clock() + wait
+                self.__counts[OPEN]['opened'] += 1
+                log.warn('%s: circuit open for %.1f sec after %d failures',
+                         self.name, wait, self.__failures)
+
+    def snapshot(self):
+        '''Get counts by state in JSON-friendly form.
+        '''
+        with self.__lock:
+            return dict(((s, dict(counts))
+                         for (s, counts) in self.__counts.items()),
+                        state=self._state(self.__clock()))
+
+
+@injector.singleton
+class Breakers(object):
+    '''Circuit breakers, by name, shared by all who use a service.
+
+    >>> b = Breakers()
+    >>> b.breaker('redcap') is b.breaker('redcap')
+    True
+    >>> b.snapshot()['redcap']['state']
+    'closed'
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._breakers = {}
+
+    def breaker(self, name, **kwargs):
+        with self._lock:
+            if name not in self._breakers:
+                self._breakers[name] = CircuitBreaker(name, **kwargs)
+            return self._breakers[name]
+
+    def snapshot(self):
+        with self._lock:
+            breakers = list(self._breakers.items())
+        return dict((name, cb.snapshot()) for (name, cb) in breakers)
+
+
+def guard(engine, breaker):
+    '''Make new connections to engine's database through breaker.
+
+    >>> from sqlalchemy import create_engine
+    >>> cb = CircuitBreaker('mem')
+    >>> engine = guard(create_engine('sqlite://'), cb)
+    >>> engine.execute('select 1').scalar()
+    1
+    >>> sorted(cb.snapshot()['closed'].items())
+    [('failed', 0), ('succeeded', 1)]
+    '''
+    def connect(dialect, conn_rec, cargs, cparams):
+        return breaker.call(lambda: dialect.connect(*cargs, **cparams))
+    event.listen(engine, 'do_connect', connect)
+    return engine
+
+
+def backoff(attempt, base=0.1, cap=5, rng=random.random):
+    '''Seconds to wait before retry number `attempt`: exponential,
+    with "full jitter".
+
+    >>> [backoff(n, rng=lambda: 1.0) for n in range(8)]
+    [0.1, 0.2, 0.4, 0.8, 1.6, 3.2, 5.0, 5.0]
+    '''
+    return rng() * min(cap, base * 2 ** attempt)
@@ -1,40 +1,847 @@
 '''cache_remote -- cache answers to remote queries
+------------------------------------------------
+
+A :class:`Cache` remembers the answer to a query until it expires::
+
+  >>> from datetime import timedelta
+  >>> import rtconfig
+  >>> logged = rtconfig._printLogs()
+  >>> clock = rtconfig.MockClock()
+  >>> c = Cache(clock.now, max_entries=3)
+  >>> def thunk(k, ttl=timedelta(seconds=10)):
+  ...     return lambda: (ttl, k.upper())
+
+  >>> c._query('a', thunk('a'), 'demo')
+  'A'
+  >>> print(logged())
+  INFO:cache_remote:Cache@1 cache initialized
+  INFO:cache_remote:demo query for a
+  INFO:cache_remote:... cached until 2011-09-02 00:00:10.500000
+
+  >>> c._query('a', thunk('a'), 'demo')
+  'A'
+  >>> print(logged())
+  <BLANKLINE>
+
+The number of entries is bounded; the least recently used entry is
+evicted to make room::
+
+  >>> [c._query(k, thunk(k), 'demo') for k in 'bc']
+  ['B', 'C']
+  >>> c._query('a', thunk('a'), 'demo')
+  'A'
+  >>> c._query('d', thunk('d'), 'demo')
+  'D'
+  >>> sorted(c._cache.keys())
+  ['a', 'c', 'd']
+  >>> _ = logged()
+
+Expired entries are dropped in order of expiration, using a heap,
+rather than by scanning the whole cache::
+
+  >>> clock.wait(20)
+  >>> c._query('e', thunk('e', timedelta(seconds=60)), 'demo')
+  'E'
+  >>> sorted(c._cache.keys())
+  ['e']
+  >>> len(c._expiry)
+  1
+
+Concurrent Queries
+------------------
+
+Request threads share a cache. When several of them miss on the same
+key at once, only one runs the thunk; the others wait for its answer::
+
+  >>> import threading, time
+  >>> release, calls = threading.Event(), []
+  >>> def slow():
+  ...     calls.append(1)
+  ...     release.wait()
+  ...     return timedelta(seconds=10), 'slow answer'
+
+  >>> answers = []
+  >>> ask = lambda: answers.append(c._query('s', slow, 'slow'))
+  >>> workers = [threading.Thread(target=ask) for _ in range(4)]
+  >>> for w in workers:
+  ...     w.start()
+  >>> while 's' not in c._inflight or c._inflight['s'].followers < 3:
+  ...     time.sleep(0.01)
+  >>> release.set()
+  >>> for w in workers:
+  ...     w.join()
+  >>> answers
+  ['slow answer', 'slow answer', 'slow answer', 'slow answer']
+  >>> len(calls)
+  1
+
+If the thunk fails, those waiting on it get the same exception::
+
+  >>> def lose():
+  ...     raise IOError('no route to host')
+  >>> c._query('x', lose, 'lose')
+  Traceback (most recent call last):
+    ...
+  IOError: no route to host
+  >>> 'x' in c._inflight
+  False
+
+Stale While Revalidate
+----------------------
+
+Optionally, a query can be given a grace period past its ttl, during
+which its stale answer is served immediately while a fresh one is
+fetched in the background. To keep this test deterministic, we
+"background" the work by saving it for later::
+
+  >>> pending = []
+  >>> swr = Cache(clock.now, revalidate=pending.append)
+  >>> answers = iter(['v1', 'v2', 'v3'])
+  >>> def fetch():
+  ...     return timedelta(seconds=10), next(answers)
+  >>> grace = timedelta(seconds=60)
+
+  >>> _ = logged()
+  >>> swr._query('k', fetch, 'swr', grace=grace)
+  'v1'
+  >>> clock.wait(20)
+  >>> swr._query('k', fetch, 'swr', grace=grace)
+  'v1'
+  >>> print(logged())
+  INFO:cache_remote:swr query for k
+  INFO:cache_remote:... cached until 2011-09-02 00:00:36.500000
+  INFO:cache_remote:swr stale for k; revalidating
+
+The refresh is only started once, no matter how many requests see
+the stale answer::
+
+  >>> swr._query('k', fetch, 'swr', grace=grace)
+  'v1'
+  >>> len(pending)
+  1
+  >>> pending.pop()()
+  'v2'
+  >>> swr._query('k', fetch, 'swr', grace=grace)
+  'v2'
+
+If the refresh can't be started in the background (say, too many
+are running already), it's done right away::
+
+  >>> def busy(work):
+  ...     raise RuntimeError('too busy')
+  >>> clock2 = rtconfig.MockClock()
+  >>> swr2 = Cache(clock2.now, revalidate=busy)
+  >>> swr2._query('k', lambda: (timedelta(seconds=10), 'old'), 'b', grace)
+  'old'
+  >>> clock2.wait(20)
+  >>> swr2._query('k', lambda: (timedelta(seconds=10), 'new'), 'b', grace)
+  'new'
+  >>> swr2._inflight
+  {}
+  >>> _ = logged()
+
+Past the grace period, callers block on a fresh answer as usual::
+
+  >>> clock.wait(100)
+  >>> swr._query('k', fetch, 'swr', grace=grace)
+  'v3'
+
+Negative Answers
+----------------
+
+Queries for things that don't exist (departed staff, mistyped ids)
+can be told apart from the rest by a `negative` test. Negative
+answers are kept for `negative_ttl` rather than the thunk's ttl,
+and are counted against their own, separate budget, so that a
+flurry of misses cannot crowd out useful entries::
+
+  >>> neg = Cache(clock.now, max_entries=2,
+  ...             negative_ttl=timedelta(seconds=300), max_negative=2)
+  >>> people = {'bob': 'Bob', 'sue': 'Sue'}
+  >>> def who(uid):
+  ...     return lambda: (timedelta(seconds=10), people.get(uid))
+  >>> is_none = lambda v: v is None
+
+  >>> _ = logged()
+  >>> [neg._query(uid, who(uid), 'who', negative=is_none)
+  ...  for uid in ['bob', 'sue', 'xyz', 'abc', 'zzz']]
+  ['Bob', 'Sue', None, None, None]
+  >>> sorted(neg._cache.keys()), sorted(neg._negative.keys())
+  (['bob', 'sue'], ['abc', 'zzz'])
+  >>> print(logged())
+  ... # doctest: +ELLIPSIS
+  INFO:cache_remote:who query for bob
+  ...
+  INFO:cache_remote:who query for zzz
+  INFO:cache_remote:... (negative) cached until 2011-09-02 00:07:31
+
+Once the positive answers expire, the negative ones are still
+remembered::
+
+  >>> clock.wait(60)
+  >>> neg._query('zzz', who('zzz'), 'who', negative=is_none) is None
+  True
+  >>> print(logged())
+  <BLANKLINE>
+  >>> neg._query('bob', who('bob'), 'who', negative=is_none)
+  'Bob'
+  >>> sorted(neg._cache.keys()), sorted(neg._negative.keys())
+  (['bob'], ['abc', 'zzz'])
+
+Statistics
+----------
+
+Hits, misses, and thunk latency are counted by query label, and
+entries by cache; caches may share a :class:`CacheStats`::
+
+  >>> stats = CacheStats()
+  >>> c1 = Cache(clock.now, stats=stats)
+  >>> c1._query('k1', thunk('k1'), 'demo')
+  'K1'
+  >>> c1._query('k1', thunk('k1'), 'demo')
+  'K1'
+  >>> c1._query('x', lose, 'lose')
+  Traceback (most recent call last):
+    ...
+  IOError: no route to host
+  >>> c2 = Cache(clock.now, stats=stats)
+  >>> c2._query('zzz', who('zzz'), 'who', negative=is_none) is None
+  True
+
+  >>> from pprint import pprint
+  >>> snap = stats.snapshot()
+  >>> pprint(snap['caches'])
+  {'Cache': {'entries': 1, 'negative': 1}}
+  >>> demo_stats = snap['queries']['demo']
+  >>> pprint(dict((k, v) for (k, v) in demo_stats.items()
+  ...             if k != 'latency_ms'))
+  {'errors': 0,
+   'hit_ratio': 0.5,
+   'hits': 1,
+   'misses': 1,
+   'negative': 0,
+   'shared': 0,
+   'stale': 0,
+   'waits': 0}
+  >>> [bound for (bound, qty) in demo_stats['latency_ms']]
+  [1, 10, 100, 1000, 10000, None]
+  >>> sum(qty for (bound, qty) in demo_stats['latency_ms'])
+  1
+  >>> snap['queries']['lose']['errors'], snap['queries']['who']['negative']
+  (1, 1)
+
+Batches
+-------
+
+When the remote service can answer several queries at once,
+:meth:`Cache._query_many` asks it only about those not already cached,
+in one batch, and caches each answer separately::
+
+  >>> batches = []
+  >>> def upper_many(ks):
+  ...     batches.append(ks)
+  ...     return timedelta(seconds=10), [k.upper() for k in ks]
+  >>> c._query('m', thunk('m'), 'demo')
+  'M'
+  >>> _ = logged()
+  >>> c._query_many(['m', 'n', 'o', 'n'], upper_many, 'demo')
+  ['M', 'N', 'O', 'N']
+  >>> batches
+  [['n', 'o']]
+  >>> print(logged())
+  INFO:cache_remote:demo query for ['n', 'o']
+  INFO:cache_remote:... cached until 2011-09-02 00:03:45
+  >>> c._query('o', thunk('o'), 'demo')
+  'O'
+
+Sharing Among Processes
+-----------------------
+
+Each process has its own caches; to avoid N processes making N times
+the queries, give them a second-level store that they share, such as
+a :class:`SQLiteStore`::
+
+  >>> import os, shutil, sqlite3, tempfile
+  >>> tmp = tempfile.mkdtemp()
+  >>> db = os.path.join(tmp, 'cache.db')
+  >>> calls = []
+  >>> def ask_ldap():
+  ...     calls.append(1)
+  ...     return timedelta(seconds=10), [('cn=bob', {'sn': ['Smith']})]
+
+  >>> proc1 = Cache(clock.now, store=SQLiteStore(
+  ...     lambda: sqlite3.connect(db)))
+  >>> proc2 = Cache(clock.now, store=SQLiteStore(
+  ...     lambda: sqlite3.connect(db)))
+  >>> _ = logged()
+  >>> proc1._query('bob', ask_ldap, 'LDAP')
+  [('cn=bob', {'sn': ['Smith']})]
+  >>> proc2._query('bob', ask_ldap, 'LDAP')
+  [('cn=bob', {'sn': ['Smith']})]
+  >>> len(calls)
+  1
+  >>> print(logged())
+  INFO:cache_remote:LDAP query for bob
+  INFO:cache_remote:... cached until 2011-09-02 00:03:46
+
+Once the shared entry expires, it's fetched again::
+
+  >>> clock.wait(20)
+  >>> proc2._query('bob', ask_ldap, 'LDAP')
+  [('cn=bob', {'sn': ['Smith']})]
+  >>> len(calls)
+  2
+
+A process that doesn't refresh in the background may still get an
+answer with a grace period from one that does; once it's stale, it
+is refreshed right away::
+
+  >>> swr1 = Cache(clock.now, revalidate=lambda work: None,
+  ...              store=SQLiteStore(lambda: sqlite3.connect(db)))
+  >>> sync2 = Cache(clock.now, store=SQLiteStore(
+  ...     lambda: sqlite3.connect(db)))
+  >>> grace = timedelta(seconds=60)
+  >>> swr1._query('g', lambda: (timedelta(seconds=10), 'old'), 'g', grace)
+  'old'
+  >>> sync2._query('g', lambda: (timedelta(seconds=10), 'new'), 'g', grace)
+  'old'
+  >>> clock.wait(20)
+  >>> sync2._query('g', lambda: (timedelta(seconds=10), 'new'), 'g', grace)
+  'new'
+
+Entries are stored as JSON; tuples, strings, and times come back
+as they went in::
+
+  >>> from datetime import datetime
+  >>> when = (datetime(2011, 9, 2), u'caf\xe9', 'cn=bob', None)
+  >>> _ = proc1._query('when', lambda: (timedelta(seconds=10), when), 'w')
+  >>> proc2._query('when', lambda: (timedelta(seconds=10), 'x'), 'w') == when
+  True
+
+Answers that JSON can't represent, such as functions or namedtuples,
+are just not shared::
+
+  >>> proc1._query('f', lambda: (timedelta(seconds=10), lambda: 1), 'fn')
+  ... # doctest: +ELLIPSIS
+  <function <lambda> at ...>
+  >>> proc2._query('f', lambda: (timedelta(seconds=10), 'not shared'), 'fn')
+  'not shared'
+
+Likewise bytes that aren't UTF-8::
+
+  >>> proc1._query('jpg', lambda: (timedelta(seconds=10), '\\xff\\xd8'), 'b')
+  '\\xff\\xd8'
+  >>> proc2._query('jpg', lambda: (timedelta(seconds=10), 'other'), 'b')
+  'other'
+
+  >>> shutil.rmtree(tmp)
+
 '''
 
+from collections import OrderedDict, namedtuple
+from datetime import date, datetime
+import heapq
+import itertools
+import json
 import logging
+import sys
+import threading
+import time
+import weakref
+
+import injector
 
 log = logging.getLogger(__name__)
 
+# How to run cache refreshes in the background; see Cache(revalidate=...)
+KRevalidate = injector.Key('CacheRevalidate')
+# Second-level store shared among processes; see Cache(store=...)
+KSharedStore = injector.Key('SharedCacheStore')
+
+_Entry = namedtuple('_Entry', ['expire', 'fresh_until', 'seq', 'value'])
+
+
+class _Flight(object):
+    '''A query in progress, which other threads may wait on.
+    '''
+    def __init__(self):
+        self.done = threading.Event()
+        self.followers = 0
+        self.value = None
+        self.exc_info = None
+
+    def wait(self):
+        self.done.wait()
+        if self.exc_info:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.value
+
+
+class Background(object):
+    '''Run work in daemon threads, a few at a time; log rather than
+    propagate failure.
+
+    :param max_threads: most threads at once; past that, calls
+                        raise `RuntimeError`
+
+    >>> go = threading.Event()
+    >>> bg = Background(max_threads=1)
+    >>> bg(go.wait)
+    >>> bg(go.wait)
+    Traceback (most recent call last):
+      ...
+    RuntimeError: 1 background refreshes already running
+    >>> go.set()
+    '''
+    def __init__(self, max_threads=8):
+        self.max_threads = max_threads
+        self.__slots = threading.BoundedSemaphore(max_threads)
+
+    def __call__(self, work):
+        if not self.__slots.acquire(False):
+            raise RuntimeError('%s background refreshes already running' %
+                               self.max_threads)
+
+        def run():
+            try:
+                work()
+            except Exception:
+                log.warn('background cache refresh failed', exc_info=True)
+            finally:
+                self.__slots.release()
+
+        t = threading.Thread(target=run, name='cache_remote.background')
+        t.daemon = True
+        try:
+            t.start()
+        except:  # noqa
+            self.__slots.release()
+            raise
+
+
+background = Background()
+
+
+@injector.singleton
+class CacheStats(object):
+    '''Hit, miss, and latency counts by query label.
+    '''
+    latency_buckets = (1, 10, 100, 1000, 10000)  # upper bounds, in ms
+    events = ('hits', 'stale', 'misses', 'waits', 'shared',
+              'errors', 'negative')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._labels = {}
+        self._caches = weakref.WeakSet()
+
+    def _watch(self, cache):
+        with self._lock:
+            self._caches.add(cache)
+
+    def _counts(self, label):
+        counts = self._labels.get(label)
+        if counts is None:
+            counts = self._labels[label] = dict(
+                (event, 0) for event in self.events)
+            counts['latency'] = [0] * (len(self.latency_buckets) + 1)
+        return counts
+
+    def count(self, label, event):
+        with self._lock:
+            self._counts(label)[event] += 1
+
+    def timed(self, label, seconds):
+        ms = seconds * 1000
+        ix = len([b for b in self.latency_buckets if b < ms])
+        with self._lock:
+            self._counts(label)['latency'][ix] += 1
+
+    def snapshot(self):
+        '''Get current statistics in JSON-friendly form.
+        '''
+        with self._lock:
+            caches = list(self._caches)
+            labels = dict((label, dict(counts, latency=counts['latency'][:]))
+                          for (label, counts) in self._labels.items())
+
+        queries = {}
+        for label, counts in labels.items():
+            lookups = (counts['hits'] + counts['stale'] +
+                       counts['misses'] + counts['waits'])
+            latency = counts.pop('latency')
+            counts['hit_ratio'] = (
+                float(counts['hits'] + counts['stale']) / lookups
+                if lookups else None)
+            counts['latency_ms'] = zip(self.latency_buckets + (None,),
+                                       latency)
+            queries[label] = counts
+
+        sizes = {}
+        for cache in caches:
+            size = sizes.setdefault(cache.__class__.__name__,
+                                    dict(entries=0, negative=0))
+            size['entries'] += len(cache._cache)
+            size['negative'] += len(cache._negative)
+
+        return dict(queries=queries, caches=sizes)
+
+
+class SQLiteStore(object):
+    '''Cache entries in a SQLite database, shared by processes on a host.
+
+    The database is in write-ahead-log mode, so that readers don't
+    wait for writers. Each thread gets its own connection.
+
+    Anyone who can write the database can feed answers to every
+    process that shares it, so it should be private to the account
+    that runs the app; see :class:`rtconfig.SharedCacheInjector`.
+    Entries are JSON rather than pickles so that a bad entry is
+    at worst a wrong answer, not code to run.
+
+    The store is an optimization: failures to get or put are logged,
+    not raised.
+
+    :param connect: access to the database, e.g.
+                    `lambda: sqlite3.connect(path)`
+    '''
+    def __init__(self, connect):
+        self.__connect = connect
+        self.__local = threading.local()
+
+    def _db(self):
+        db = getattr(self.__local, 'db', None)
+        if db is None:
+            db = self.__connect()
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('''
+              create table if not exists cache_entry (
+                k text primary key,
+                expire timestamp not null,
+                entry blob not null)''')
+            db.execute('''
+              create index if not exists cache_entry_expire
+                on cache_entry (expire)''')
+            self.__local.db = db
+        return db
+
+    def get(self, k, tnow):
+        '''Get (expire, fresh_until, is_neg, value) for k, if any.
+        '''
+        try:
+            row = self._db().execute(
+                'select entry from cache_entry where k = ? and expire > ?',
+                (k, tnow)).fetchone()
+            return (tuple(_from_json(json.loads(row[0])))
+                    if row else None)
+        except Exception:  # sqlite3.Error, ValueError, ...
+            log.warn('shared cache get failed for %s', k, exc_info=True)
+            return None
+
+    def put(self, k, entry, tnow):
+        try:
+            blob = json.dumps([_to_json(part) for part in entry])
+        except (TypeError, ValueError, UnicodeError) as oops:
+            log.debug('not sharing %s: %s', k, oops)
+            return
+        try:
+            db = self._db()
+            with db:
+                db.execute('insert or replace into cache_entry'
+                           ' (k, expire, entry) values (?, ?, ?)',
+                           (k, entry[0], blob))
+                db.execute('delete from cache_entry where expire <= ?',
+                           (tnow,))
+        except Exception:  # sqlite3.Error, ...
+            log.warn('shared cache put failed for %s', k, exc_info=True)
+
+
+def _to_json(v):
+    '''Tag the types that plain JSON would lose.
+
+    :raises TypeError: for values we can't represent faithfully
+    :raises UnicodeError: for strings that aren't UTF-8
+    '''
+    t = type(v)
+    if v is None or t in (bool, int, long, float):
+        return v
+    elif t is str:
+        return v.decode('utf-8')
+    elif t is unicode:
+        return {'unicode': v}
+    elif t is list:
+        return [_to_json(item) for item in v]
+    elif t is tuple:
+        return {'tuple': [_to_json(item) for item in v]}
+    elif t is datetime:
+        return {'datetime': v.strftime('%Y-%m-%dT%H:%M:%S.%f')}
+    elif t is date:
+        return {'date': v.isoformat()}
+    elif t is dict and all(type(key) is str for key in v):
+        return {'dict': dict((key.decode('utf-8'), _to_json(item))
+                             for (key, item) in v.items())}
+    raise TypeError('cannot share %s' % t.__name__)
+
+
+def _from_json(v):
+    '''Inverse of :func:`_to_json`.
+    '''
+    if isinstance(v, unicode):
+        return v.encode('utf-8')
+    elif isinstance(v, list):
+        return [_from_json(item) for item in v]
+    elif not isinstance(v, dict):
+        return v
+    [(tag, x)] = v.items()
+    if tag == 'unicode':
+        return x
+    elif tag == 'tuple':
+        return tuple(_from_json(item) for item in x)
+    elif tag == 'datetime':
+        return datetime.strptime(x, '%Y-%m-%dT%H:%M:%S.%f')
+    elif tag == 'date':
+        return datetime.strptime(x, '%Y-%m-%d').date()
+    elif tag == 'dict':
+        return dict((key.encode('utf-8'), _from_json(item))
+                    for (key, item) in x.items())
+    raise ValueError(tag)
+
 
 class Cache(object):
-    def __init__(self, now):
+    '''Bounded LRU cache with heap-driven expiry.
+
+    Safe to share among threads; concurrent misses on one key are
+    coalesced so that the thunk runs once.
+
+    :param now: access to the current time
+    :param max_entries: bound on the number of cached answers
+    :param revalidate: a function that runs work in the background,
+                       such as :data:`background`; with this, queries
+                       given a grace period are refreshed while their
+                       stale answer is served.
+    :param negative_ttl: how long to keep negative answers; by default,
+                         the thunk's ttl
+    :param max_negative: bound on the number of negative answers
+    :param stats: where to count hits, misses, etc.; see
+                  :class:`CacheStats`
+    :param store: second-level store shared with other processes,
+                  such as a :class:`SQLiteStore`
+    '''
+    max_entries = 10000
+    max_negative = 1000
+    negative_ttl = None
+
+    def __init__(self, now, max_entries=None, revalidate=None,
+                 negative_ttl=None, max_negative=None, stats=None,
+                 store=None):
         self.__now = now
-        self._cache = {}
+        self.__store = store
+        self.__revalidate = revalidate
+        self._cache = OrderedDict()
+        self._negative = OrderedDict()
+        self._expiry = []  # heap of (expire, seq, k)
+        self._seq = itertools.count()
+        self._inflight = {}
+        self._lock = threading.Lock()
+        if max_entries is not None:
+            self.max_entries = max_entries
+        if max_negative is not None:
+            self.max_negative = max_negative
+        if negative_ttl is not None:
+            self.negative_ttl = negative_ttl
+        self._stats = stats or CacheStats()
+        self._stats._watch(self)
         ix = 1  # was global mutable state. ew.
         log.info('%s@%s cache initialized',
                  self.__class__.__name__, ix)
 
-    def _query(self, k, thunk, label=None):
+    def _query(self, k, thunk, label=None, grace=None, negative=None):
+        '''Get the answer for k, calling thunk() if needed.
+
+        :param thunk: returns (ttl, answer)
+        :param grace: how long past its ttl an answer may be served
+                      while it is refreshed in the background
+        :param negative: tests whether an answer is negative;
+                         see `negative_ttl`, `max_negative`
+        '''
         tnow = self.__now()
+        with self._lock:
+            store = self._cache
+            entry = store.pop(k, None)
+            if entry is None:
+                store = self._negative
+                entry = store.pop(k, None)
+            if entry is not None and entry.expire > tnow:
+                store[k] = entry  # most recently used goes last
+                if entry.fresh_until > tnow or k in self._inflight:
+                    self._stats.count(label, 'hits')
+                    return entry.value
+                flight = self._inflight[k] = _Flight()
+                stale = True
+                self._stats.count(label, 'stale')
+            else:
+                stale = False
+                flight = self._inflight.get(k)
+                if flight is None:
+                    flight = self._inflight[k] = _Flight()
+                    leader = True
+                    self._stats.count(label, 'misses')
+                else:
+                    flight.followers += 1
+                    leader = False
+                    self._stats.count(label, 'waits')
+
+                # We're taking the time to go over the network; now is
+                # a good time to prune the cache.
+                self._prune(tnow)
+
+        fill = lambda: self._fill(k, thunk, label, flight, tnow,
+                                  grace, negative)
+        if stale:
+            if self.__revalidate is None:
+                # e.g. an entry with a grace period from the shared store
+                log.info('%s stale for %s; refreshing', label, k)
+                return fill()
+            log.info('%s stale for %s; revalidating', label, k)
+            try:
+                self.__revalidate(fill)
+            except Exception:
+                log.warn('%s revalidation for %s not started; refreshing',
+                         label, k, exc_info=True)
+                return fill()
+            return entry.value
+
+        if not leader:
+            log.debug('%s waiting on query for %s', label, k)
+            return flight.wait()
+
+        return fill()
+
+    def _fill(self, k, thunk, label, flight, tnow, grace, negative):
+        store = self.__store
+        skey = repr((self.__class__.__name__, k)) if store else None
+        t0 = time.time()
         try:
-            expire, v = self._cache[k]
-        except KeyError:
-            pass
-        else:
-            if expire > tnow:
-                return v
-
-        # We're taking the time to go over the network; now is
-        # a good time to prune the cache.
-        self._prune(tnow)
-
-        log.info('%s query for %s', label, k)
-        ttl, v = thunk()
-        log.info('... cached until %s', tnow + ttl)
-        self._cache[k] = (tnow + ttl, v)
+            shared = store.get(skey, tnow) if store else None
+            if shared and shared[1] > tnow:
+                expire, fresh_until, is_neg, v = shared
+                self._stats.count(label, 'shared')
+                log.debug('%s shared answer for %s', label, k)
+            else:
+                log.info('%s query for %s', label, k)
+                ttl, v = thunk()
+                self._stats.timed(label, time.time() - t0)
+                is_neg = bool(negative and negative(v))
+                if is_neg:
+                    self._stats.count(label, 'negative')
+                    if self.negative_ttl is not None:
+                        ttl = self.negative_ttl
+                fresh_until = tnow + ttl
+                expire = (fresh_until + grace
+                          if grace and self.__revalidate and not is_neg
+                          else fresh_until)
+                log.info('... %scached until %s',
+                         '(negative) ' if is_neg else '', fresh_until)
+                if store:
+                    store.put(skey, (expire, fresh_until, is_neg, v), tnow)
+        except BaseException:
+            flight.exc_info = sys.exc_info()
+            self._stats.count(label, 'errors')
+            raise
+        finally:
+            with self._lock:
+                if flight.exc_info is None:
+                    flight.value = v
+                    self._put(k, expire, fresh_until, v, is_neg)
+                del self._inflight[k]
+            flight.done.set()
         return v
 
+    def _query_many(self, ks, thunk_many, label=None, negative=None):
+        '''Get answers for each of ks, calling thunk_many() on any misses.
+
+        :param thunk_many: given a list of keys, returns (ttl, answers),
+                           with answers in the same order as the keys
+        :param negative: as in :meth:`_query`
+
+        Misses are not coalesced with concurrent queries as in
+        :meth:`_query`, nor shared via the second-level store.
+        '''
+        tnow = self.__now()
+        answers = {}
+        missing = []
+        with self._lock:
+            for k in ks:
+                if k in answers or k in missing:
+                    continue
+                entry = self._touch(k)
+                if entry is not None and entry.fresh_until > tnow:
+                    self._stats.count(label, 'hits')
+                    answers[k] = entry.value
+                else:
+                    self._stats.count(label, 'misses')
+                    missing.append(k)
+            if missing:
+                self._prune(tnow)
+
+        if missing:
+            log.info('%s query for %s', label, missing)
+            t0 = time.time()
+            try:
+                ttl, vs = thunk_many(missing)
+            except BaseException:
+                self._stats.count(label, 'errors')
+                raise
+            self._stats.timed(label, time.time() - t0)
+            log.info('... cached until %s', tnow + ttl)
+            with self._lock:
+                for k, v in zip(missing, vs):
+                    is_neg = bool(negative and negative(v))
+                    if is_neg:
+                        self._stats.count(label, 'negative')
+                    until = tnow + (self.negative_ttl
+                                    if is_neg and self.negative_ttl
+                                    else ttl)
+                    self._put(k, until, until, v, is_neg)
+                    answers[k] = v
+
+        return [answers[k] for k in ks]
+
+    def _touch(self, k):
+        '''Get the entry for k, if any, marking it most recently used.
+        '''
+        for store in (self._cache, self._negative):
+            entry = store.pop(k, None)
+            if entry is not None:
+                store[k] = entry
+                return entry
+        return None
+
+    def _put(self, k, expire, fresh_until, v, is_neg=False):
+        seq = next(self._seq)
+        self._cache.pop(k, None)
+        self._negative.pop(k, None)
+        store, budget = ((self._negative, self.max_negative) if is_neg
+                         else (self._cache, self.max_entries))
+        store[k] = _Entry(expire, fresh_until, seq, v)
+        heapq.heappush(self._expiry, (expire, seq, k))
+
+        while len(store) > budget:
+            store.popitem(last=False)
+
+        # Entries that were replaced or evicted leave stale heap items;
+        # don't let them accumulate without bound.
+        if len(self._expiry) > 2 * (self.max_entries + self.max_negative):
+            self._expiry = [(e.expire, e.seq, ek)
+                            for entries in (self._cache, self._negative)
+                            for ek, e in entries.items()]
+            heapq.heapify(self._expiry)
+
     def _prune(self, tnow):
-        for k, (t, _) in self._cache.items():
-            if t <= tnow:
-                del self._cache[k]
+        expiry = self._expiry
+        while expiry and expiry[0][0] <= tnow:
+            _, seq, k = heapq.heappop(expiry)
+            for store in (self._cache, self._negative):
+                entry = store.get(k)
+                if entry is not None and entry.seq == seq:
+                    del store[k]
@@ -0,0 +1,140 @@
+'''dbpool -- shared, pooled database engines, with checkout metrics
+-----------------------------------------------------------------
+
+Making an engine (and hence a connection pool) per session means
+a new database connection per session. A :class:`SharedEngine` makes
+its engine on first use and hands out that same one thereafter::
+
+  >>> from sqlalchemy import create_engine as sa_create_engine
+  >>> from sqlalchemy.pool import QueuePool
+  >>> made = []
+  >>> def create_engine(url, **kwargs):
+  ...     made.append((url, kwargs))
+  ...     return sa_create_engine(url, poolclass=QueuePool, **kwargs)
+
+  >>> import rtconfig
+  >>> opts = rtconfig.TestTimeOptions(dict(
+  ...     db_url='sqlite://', pool_size='2', pool_pre_ping='false'))
+  >>> stats = PoolStats()
+  >>> engine = SharedEngine(
+  ...     'demo', lambda: create_engine(opts.db_url, **pool_kwargs(opts)),
+  ...     stats)
+  >>> engine() is engine()
+  True
+  >>> [(url, sorted(kwargs.items())) for (url, kwargs) in made]
+  ... # doctest: +NORMALIZE_WHITESPACE
+  [('sqlite://', [('pool_pre_ping', False), ('pool_recycle', 3600),
+                  ('pool_size', 2)])]
+
+Connection checkouts are counted, so we can tell how busy the pool
+gets::
+
+  >>> c1, c2 = engine().connect(), engine().connect()
+  >>> c1.close()
+  >>> c3 = engine().connect()
+  >>> c2.close(); c3.close()
+  >>> from pprint import pprint
+  >>> pprint(stats.snapshot())
+  ... # doctest: +ELLIPSIS
+  {'demo': {'checked_out': 0,
+            'checkouts': 3,
+            'connects': 2,
+            'invalidated': 0,
+            'peak': 2,
+            'status': 'Pool size: 2  Connections in pool: 2 ...'}}
+
+'''
+
+import logging
+import threading
+
+import injector
+from sqlalchemy import event
+
+log = logging.getLogger(__name__)
+
+# Options for each database section; see pool_kwargs
+POOL_OPTIONS = ['pool_size', 'max_overflow', 'pool_timeout',
+                'pool_recycle', 'pool_pre_ping']
+
+
+def pool_kwargs(rt, pool_recycle=3600, pool_pre_ping=True):
+    '''Get create_engine() keyword args from POOL_OPTIONS in rt.
+
+    >>> import rtconfig
+    >>> sorted(pool_kwargs(rtconfig.TestTimeOptions(
+    ...     dict(max_overflow='5'))).items())
+    [('max_overflow', 5), ('pool_pre_ping', True), ('pool_recycle', 3600)]
+    '''
+    kwargs = dict(pool_recycle=pool_recycle, pool_pre_ping=pool_pre_ping)
+    for name in POOL_OPTIONS:
+        val = getattr(rt, name, None)
+        if val is None:
+            continue
+        kwargs[name] = (val.lower() in ('1', 'true')
+                        if name == 'pool_pre_ping' else int(val))
+    return kwargs
+
+
+@injector.singleton
+class PoolStats(object):
+    '''Connection pool checkout counts, by engine name.
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pools = {}
+
+    def watch(self, name, engine):
+        counts = dict(connects=0, checkouts=0, checked_out=0,
+                      peak=0, invalidated=0)
+        with self._lock:
+            self._pools[name] = (engine, counts)
+
+        def bump(event_name, delta=1):
+            with self._lock:
+                counts[event_name] += delta
+                counts['peak'] = max(counts['peak'], counts['checked_out'])
+
+        event.listen(engine, 'connect', lambda *_: bump('connects'))
+
+        def checkout(*_):
+            bump('checkouts')
+            bump('checked_out')
+        event.listen(engine, 'checkout', checkout)
+        event.listen(engine, 'checkin', lambda *_: bump('checked_out', -1))
+        event.listen(engine, 'invalidate', lambda *_: bump('invalidated'))
+
+    def snapshot(self):
+        '''Get current statistics in JSON-friendly form.
+        '''
+        with self._lock:
+            pools = [(name, engine, dict(counts))
+                     for (name, (engine, counts)) in self._pools.items()]
+        return dict((name, dict(counts, status=engine.pool.status()))
+                    for (name, engine, counts) in pools)
+
+
+class SharedEngine(object):
+    '''Make an engine on first use; share it thereafter.
+
+    :param name: for logging and :class:`PoolStats`
+    :param make: thunk to create the engine
+    :param stats: optional :class:`PoolStats`
+    '''
+    def __init__(self, name, make, stats=None):
+        self.name = name
+        self.__make = make
+        self.__stats = stats
+        self.__engine = None
+        self.__lock = threading.Lock()
+
+    def __call__(self):
+        if self.__engine is None:
+            with self.__lock:
+                if self.__engine is None:
+                    engine = self.__make()
+                    log.info('%s engine: %s', self.name, engine.pool.status())
+                    if self.__stats:
+                        self.__stats.watch(self.name, engine)
+                    self.__engine = engine
+        return self.__engine
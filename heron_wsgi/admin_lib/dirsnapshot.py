@@ -0,0 +1,176 @@
+'''dirsnapshot -- local directory snapshot for searches by name
+-------------------------------------------------------------
+
+Team builder searches the directory by name prefix as the user types.
+Rather than send each search to the enterprise directory, we can keep
+a snapshot of it, indexed by cn, sn and givenname::
+
+  >>> import rtconfig
+  >>> from ldaplib import LDAPService, MockLDAP, _sample_settings
+  >>> server = MockLDAP()
+  >>> svc = LDAPService(rtconfig.MockClock().now, ttl=2,
+  ...                   rt=_sample_settings, ldap=server, flags=MockLDAP)
+  >>> snap = DirectorySnapshot(svc, ['cn', 'sn', 'givenname', 'title'],
+  ...                          page_size=4)
+  >>> snap.refresh()
+  10
+
+The directory is fetched a page at a time::
+
+  >>> server.pages
+  3
+
+  >>> snap.search_name_clues(5, '', 'stu', '', ['givenname'])
+  ... # doctest: +NORMALIZE_WHITESPACE
+  [('(cn=bill.student)', {'givenname': ['Bill']}),
+   ('(cn=carol.student)', {'givenname': ['Carol']}),
+   ('(cn=jill.student)', {'givenname': ['jill']})]
+
+Prefixes are matched without regard to case, and all clues given
+must match::
+
+  >>> snap.search_name_clues(5, '', 'stu', 'J', ['cn'])
+  [('(cn=jill.student)', {'cn': ['jill.student']})]
+  >>> snap.search_name_clues(1, '', 'Stu', '', ['cn'])
+  [('(cn=bill.student)', {'cn': ['bill.student']})]
+  >>> snap.search_name_clues(5, 'nobody', '', '', ['cn'])
+  []
+
+Later refreshes fetch only entries modified since the last one::
+
+  >>> server.update('john.smith', '20111001000000Z', title='Dean')
+  >>> snap.refresh()
+  1
+  >>> snap.search_name_clues(5, 'john', '', '', ['title'])
+  [('(cn=john.smith)', {'title': ['Dean']})]
+
+Searches for attributes outside the snapshot, or before the snapshot
+is loaded, go to the directory::
+
+  >>> snap.search_name_clues(5, 'john.smith', '', '', ['mail'])
+  [('(cn=john.smith)', {'mail': ['john.smith@js.example']})]
+
+'''
+
+from bisect import bisect_left
+import logging
+import threading
+
+log = logging.getLogger(__name__)
+
+INDEXED = ('cn', 'sn', 'givenname')
+
+
+class DirectorySnapshot(object):
+    '''Answer searches by name prefix from a local copy of the directory.
+
+    :param svc: an :class:`ldaplib.LDAPService`
+    :param attrs: directory attributes to keep
+    :param interval: seconds between refreshes, or None to leave
+                     the snapshot empty, deferring to `svc`
+    :param full_every: reload everything (to catch departures)
+                       every this many refreshes
+    :param query: LDAP filter for entries to include
+    :param base: search base; default: that of `svc`
+    :param page_size: entries to fetch per request
+    '''
+    def __init__(self, svc, attrs, interval=None, full_every=96,
+                 query='(cn=*)', base=None, page_size=500):
+        self.__svc = svc
+        self.attrs = sorted(set(attrs) | set(INDEXED))
+        self.interval = interval
+        self.full_every = full_every
+        self.query = query
+        self.base = base
+        self.page_size = page_size
+        self.__stop = threading.Event()
+        self.__lock = threading.Lock()
+        self.__refreshes = 0
+        self.__entries = {}  # cn -> (dn, attrs)
+        self.__stamp = None  # latest modifyTimestamp seen
+        self.__index = None  # attr -> sorted [(value.lower(), cn)]
+
+    def search_name_clues(self, max_qty, cn, sn, givenname, attrs):
+        '''Search as :meth:`ldaplib.LDAPService.search_name_clues` does.
+        '''
+        index, entries = self.__index, self.__entries
+        if index is None or not set(attrs) <= set(self.attrs):
+            return self.__svc.search_name_clues(max_qty, cn, sn, givenname,
+                                                attrs)
+        clues = [(n, v.lower()) for (n, v) in zip(INDEXED,
+                                                  (cn, sn, givenname))
+                 if v]
+        if not clues:
+            return []
+        hits = None
+        for name, prefix in clues:
+            found = set(_prefixed(index[name], prefix))
+            hits = found if hits is None else hits & found
+        return [(dn, dict((a, entry[a]) for a in attrs if a in entry))
+                for (dn, entry) in [entries[k] for k in sorted(hits)]
+                ][:max_qty]
+
+    def refresh(self, full=False):
+        '''Fetch entries modified since the last refresh; re-index.
+
+        :return: number of entries fetched
+        '''
+        with self.__lock:
+            full = full or self.__stamp is None
+            query = self.query if full else (
+                '(&%s(modifyTimestamp>=%s))' % (self.query, self.__stamp))
+            found = self.__svc.search_remote_paged(
+                query, self.attrs + ['modifyTimestamp'],
+                base=self.base, page_size=self.page_size)
+            entries = {} if full else dict(self.__entries)
+            stamp = self.__stamp
+            for dn, attrs in found:
+                stamp = max([stamp] + attrs.pop('modifyTimestamp', []))
+                for cn in attrs.get('cn', []):
+                    entries[cn] = (dn, attrs)
+            index = dict((name, sorted((v.lower(), cn)
+                                       for (cn, (_, attrs)) in entries.items()
+                                       for v in attrs.get(name, [])))
+                         for name in INDEXED)
+            # Readers get the old entries and index or the new ones.
+            self.__entries, self.__index = entries, index
+            self.__stamp = stamp or '19700101000000Z'
+            log.info('directory snapshot: %d of %d entries refreshed',
+                     len(found), len(entries))
+            return len(found)
+
+    def start(self):
+        '''Refresh every `interval` seconds in a background thread,
+        if `interval` is set.
+        '''
+        if not self.interval:
+            return None
+        t = threading.Thread(target=self._loop,
+                             name='dirsnapshot.DirectorySnapshot')
+        t.daemon = True
+        t.start()
+        return t
+
+    def stop(self):
+        self.__stop.set()
+
+    def _loop(self):
+        while not self.__stop.is_set():
+            try:
+                self.refresh(full=self.__refreshes % self.full_every == 0)
+                self.__refreshes += 1
+            except Exception:
+                log.warn('directory snapshot refresh failed', exc_info=True)
+            self.__stop.wait(self.interval)
+
+
+def _prefixed(index, prefix):
+    '''Find keys of index entries whose values start with prefix.
+
+    >>> list(_prefixed([('ab', 1), ('abc', 2), ('b', 3)], 'ab'))
+    [1, 2]
+    '''
+    ix = bisect_left(index, (prefix,))
+    while ix < len(index) and index[ix][0].startswith(prefix):
+        yield index[ix][1]
+        ix += 1
@@ -0,0 +1,150 @@
+'''fanout -- run independent lookups concurrently, with timeouts
+----------------------------------------------------------------
+
+:func:`gather` submits each of several tasks to a pool, then collects
+their answers, waiting no longer than each task's timeout, counted
+from when it starts to run::
+
+  >>> from multiprocessing.pool import ThreadPool
+  >>> import threading
+  >>> import rtconfig
+  >>> logged = rtconfig._printLogs()
+  >>> gate = threading.Event()
+  >>> pool = ThreadPool(2)
+  >>> gather(pool, [('quick', lambda: 'fast answer', 1, None),
+  ...               ('slow', gate.wait, 0.05, 'unknown')])
+  ['fast answer', 'unknown']
+  >>> print(logged())
+  WARNING:fanout:slow: no answer in 0.05 sec; using 'unknown'
+  >>> gate.set()
+
+A timeout of `None` means wait as long as it takes::
+
+  >>> gather(pool, [('patient', lambda: 'eventually', None, 'unknown')])
+  ['eventually']
+
+A task that is still waiting for the pool when its time is up is run
+by the caller instead, so a busy pool doesn't make for lost answers::
+
+  >>> busy = threading.Event()
+  >>> _ = [pool.apply_async(busy.wait) for _ in range(2)]
+  >>> gather(pool, [('queued', lambda: 'answer', 0.05, 'unknown')])
+  ['answer']
+  >>> print(logged())
+  WARNING:fanout:queued: not started in 0.05 sec; running it here
+  >>> busy.set()
+
+Exceptions are passed along, as if the task were called directly::
+
+  >>> gather(pool, [('oops', lambda: 1 / 0, 1, None)])
+  Traceback (most recent call last):
+    ...
+  ZeroDivisionError: integer division or modulo by zero
+  >>> pool.terminate()
+
+For deterministic tests, an :class:`InlinePool` runs each task as
+it is submitted::
+
+  >>> order = []
+  >>> gather(InlinePool(), [('a', lambda: order.append('a'), 1, None),
+  ...                       ('b', lambda: order.append('b'), 1, None)])
+  [None, None]
+  >>> order
+  ['a', 'b']
+
+'''
+
+from multiprocessing import TimeoutError
+import logging
+import sys
+import threading
+import time
+
+import injector
+
+log = logging.getLogger(__name__)
+
+# A pool with an apply_async() method, such as
+# multiprocessing.pool.ThreadPool or InlinePool.
+KFanOut = injector.Key('FanOut')
+
+
+def gather(pool, tasks):
+    '''Run tasks concurrently; collect their answers.
+
+    :param pool: as in :data:`KFanOut`
+    :param tasks: a list of (what, thunk, timeout, default), where
+                  default is the answer if thunk runs more than timeout
+                  seconds (though it is left to run to completion,
+                  holding its place in the pool); timeout may be
+                  `None` to wait indefinitely.
+    :return: a list of answers, in order of tasks
+    '''
+    pending = []
+    for (what, thunk, timeout, default) in tasks:
+        task = _Task(thunk)
+        pending.append((what, task, pool.apply_async(task),
+                        timeout, default))
+    return [_settle(*p) for p in pending]
+
+
+def _settle(what, task, result, timeout, default):
+    if not task.started.wait(timeout) and task.claim():
+        log.warn('%s: not started in %s sec; running it here',
+                 what, timeout)
+        return task.thunk()
+    task.started.wait()  # in case the pool claimed it just now
+    remaining = (None if timeout is None
+                 else max(0, task.t_start + timeout - time.time()))
+    try:
+        return result.get(remaining)
+    except TimeoutError:
+        log.warn('%s: no answer in %s sec; using %r',
+                 what, timeout, default)
+        return default
+
+
+class _Task(object):
+    '''A thunk that runs once: in the pool or, failing that, the caller.
+    '''
+    def __init__(self, thunk):
+        self.thunk = thunk
+        self.started = threading.Event()
+        self.t_start = None
+        self._claimed = False
+        self._lock = threading.Lock()
+
+    def claim(self):
+        with self._lock:
+            if self._claimed:
+                return False
+            self._claimed = True
+            return True
+
+    def __call__(self):
+        if not self.claim():
+            return None  # the caller ran it
+        self.t_start = time.time()
+        self.started.set()
+        return self.thunk()
+
+
+class InlinePool(object):
+    '''Run each task as it is submitted.
+    '''
+    def apply_async(self, func, args=()):
+        return _Done(func, args)
+
+
+class _Done(object):
+    def __init__(self, func, args):
+        self._exc_info = None
+        try:
+            self._value = func(*args)
+        except Exception:
+            self._exc_info = sys.exc_info()
+
+    def get(self, timeout=None):
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._value
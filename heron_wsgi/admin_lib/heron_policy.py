@@ -41,8 +41,10 @@ investigator requests::
   >>> print(logged())
   ... # doctest: +NORMALIZE_WHITESPACE +ELLIPSIS
   INFO:cache_remote:LDAP query for ('(cn=john.smith)', ...
-  INFO:cache_remote:system access query for ('SAA', 'john.smith@js.example')
-  INFO:cache_remote:... cached until 2011-09-02 00:00:15.500000
+  INFO:cache_remote:Training query for ('training', 'john.smith')
+  INFO:cache_remote:... cached until 2011-09-02 00:30:00.500000
+  INFO:cache_remote:system access query for [('SAA', 'john.smith@js.example')]
+  INFO:cache_remote:... cached until 2011-09-02 00:00:16
   INFO:cache_remote:in DROC? query for john.smith
   INFO:cache_remote:... cached until 2011-09-02 00:01:00.500000
   >>> facreq.context.status  # doctest: +NORMALIZE_WHITESPACE
@@ -100,7 +102,7 @@ survey, using :mod:`heron_wsgi.admin_lib.redcap_connect`::
    's=aqFVbr&full_name=Smith%2C+John&user_id=john.smith']
   >>> print(logged())
   INFO:cache_remote:SAA link query for ('SAA', 'john.smith')
-  INFO:cache_remote:... cached until 2011-09-02 00:00:16.500000
+  INFO:cache_remote:... cached until 2011-09-02 00:00:17.500000
 
 Any CAS authenticated user can sign Data Usage Agreement
 ********************************************************
@@ -132,10 +134,13 @@ faculty not sponsored, nor has he completed human subjects training::
   INFO:cache_remote:LDAP query for ('(cn=bill.student)', ...
   INFO:cache_remote:Sponsorship query for ('sponsorship', 'bill.student')
   INFO:heron_policy:not sponsored: bill.student
-  INFO:cache_remote:... cached until 2011-09-02 00:00:03.500000
+  INFO:cache_remote:... (negative) cached until 2011-09-02 00:01:03.500000
+  INFO:cache_remote:Training query for ('training', 'bill.student')
   INFO:heron_policy:no training on file for: bill.student (Bill Student)
-  INFO:cache_remote:system access query for ('SAA', 'bill.student@js.example')
-  INFO:cache_remote:... cached until 2011-09-02 00:00:18
+  INFO:cache_remote:... (negative) cached until 2011-09-02 00:01:04
+  INFO:cache_remote:system access query for
+       [('SAA', 'bill.student@js.example')]
+  INFO:cache_remote:... cached until 2011-09-02 00:00:19.500000
   INFO:cache_remote:in DROC? query for bill.student
   INFO:cache_remote:... cached until 2011-09-02 00:01:01.500000
   >>> stureq.context.status  #doctest: +NORMALIZE_WHITESPACE
@@ -200,12 +205,15 @@ This student's sponsor is not with KUMC anymore
   INFO:cache_remote:Sponsorship query for ('sponsorship', 'jill.student')
   INFO:cache_remote:LDAP query for (u'(cn=prof.fickle)', ('cn', 'givenname',
        'kumcPersonFaculty', 'kumcPersonJobcode', 'mail', 'ou', 'sn', 'title'))
-  INFO:cache_remote:... cached until 2011-09-02 00:00:08
+  INFO:cache_remote:... (negative) cached until 2011-09-02 00:00:08
   WARNING:heron_policy:Sponsor prof.fickle not at med center anymore.
   INFO:heron_policy:not sponsored: jill.student
-  INFO:cache_remote:... cached until 2011-09-02 00:00:07.500000
-  INFO:cache_remote:system access query for ('SAA', 'jill.student@js.example')
-  INFO:cache_remote:... cached until 2011-09-02 00:00:22
+  INFO:cache_remote:... (negative) cached until 2011-09-02 00:01:09.500000
+  INFO:cache_remote:Training query for ('training', 'jill.student')
+  INFO:cache_remote:... cached until 2011-09-02 00:30:10
+  INFO:cache_remote:system access query for
+       [('SAA', 'jill.student@js.example')]
+  INFO:cache_remote:... cached until 2011-09-02 00:00:25.500000
   INFO:cache_remote:in DROC? query for jill.student
   INFO:cache_remote:... cached until 2011-09-02 00:01:03.500000
 
@@ -218,8 +226,10 @@ Ensure things don't go wonky in case of missing email address
        'kumcPersonFaculty', 'kumcPersonJobcode', 'mail', 'ou', 'sn', 'title'))
     INFO:cache_remote:... cached until 2011-09-02 00:00:08.500000
     WARNING:medcenter:missing LDAP attribute mail for todd.ryan
-    INFO:cache_remote:system access query for ('SAA', 'todd.ryan@js.example')
-    INFO:cache_remote:... cached until 2011-09-02 00:00:22.500000
+    INFO:cache_remote:Training query for ('training', 'todd.ryan')
+    INFO:cache_remote:... cached until 2011-09-02 00:30:11
+    INFO:cache_remote:system access query for [('SAA', 'todd.ryan@js.example')]
+    INFO:cache_remote:... cached until 2011-09-02 00:00:26.500000
     INFO:cache_remote:in DROC? query for todd.ryan
     INFO:cache_remote:... cached until 2011-09-02 00:01:04
 
@@ -245,8 +255,10 @@ Executives don't need sponsorship::
   INFO:cache_remote:LDAP query for ('(cn=big.wig)', ('cn', 'givenname',
        'kumcPersonFaculty', 'kumcPersonJobcode', 'mail', 'ou', 'sn', 'title'))
   INFO:cache_remote:... cached until 2011-09-02 00:00:09
-  INFO:cache_remote:system access query for ('SAA', 'big.wig@js.example')
-  INFO:cache_remote:... cached until 2011-09-02 00:00:23
+  INFO:cache_remote:Training query for ('training', 'big.wig')
+  INFO:cache_remote:... cached until 2011-09-02 00:30:12
+  INFO:cache_remote:system access query for [('SAA', 'big.wig@js.example')]
+  INFO:cache_remote:... cached until 2011-09-02 00:00:27.500000
   INFO:cache_remote:in DROC? query for big.wig
   INFO:cache_remote:... cached until 2011-09-02 00:01:04.500000
 
@@ -361,7 +373,8 @@ import noticelog
 from noticelog import OVERSIGHT_CONFIG_SECTION
 import disclaimer
 from audit_usage import I2B2AggregateUsage, I2B2SensitiveUsage
-from cache_remote import Cache
+from cache_remote import Cache, CacheStats, KRevalidate, KSharedStore
+import fanout
 
 SAA_CONFIG_SECTION = 'saa_survey'
 DUA_CONFIG_SECTION = 'dua_survey'
@@ -387,10 +400,11 @@ class OversightCommittee(Token, Cache):
             mc=medcenter.MedCenter,
             timesrc=rtconfig.Clock,
             auditor=I2B2SensitiveUsage,
-            dr=noticelog.DecisionRecords)
+            dr=noticelog.DecisionRecords,
+            stats=CacheStats)
     def __init__(self, redcap_sessionmaker, oversight_rc, mc,
-                 timesrc, auditor, dr):
-        Cache.__init__(self, timesrc.now)
+                 timesrc, auditor, dr, stats):
+        Cache.__init__(self, timesrc.now, stats=stats)
         self.__rcsm = redcap_sessionmaker
         self.project_id = oversight_rc.project_id
         self.__mc = mc
@@ -472,6 +486,12 @@ class HeronRecords(Token, Cache):
     oversight_request_purposes = (SPONSORSHIP, DATA_USE,
                                   ACT_SPONSORSHIP, GREENHERON_USE)
 
+    # Remember who is not sponsored for a minute, not just a second.
+    negative_ttl = timedelta(seconds=60)
+    # Current sponsorships to fetch at a time, looking for
+    # a sponsor still on staff
+    sponsorships_page = 10
+
     @inject(mc=medcenter.MedCenter,
             pm=i2b2pm.I2B2PM,
             dr=noticelog.DecisionRecords,
@@ -486,10 +506,16 @@ class HeronRecords(Token, Cache):
             dg=disclaimer.DisclaimerGuard,
             smaker=(orm.session.Session,
                     redcapdb.CONFIG_SECTION),
-            timesrc=rtconfig.Clock)
+            timesrc=rtconfig.Clock,
+            revalidate=KRevalidate,
+            cache_stats=CacheStats,
+            store=KSharedStore,
+            pool=fanout.KFanOut)
     def __init__(self, mc, pm, dr, stats, saa_rc, dua_rc, oversight_rc, oc,
-                 dg, smaker, timesrc):
-        Cache.__init__(self, timesrc.now)
+                 dg, smaker, timesrc, revalidate, cache_stats, store, pool):
+        Cache.__init__(self, timesrc.now, revalidate=revalidate,
+                       stats=cache_stats, store=store)
+        self._pool = pool
         log.debug('HeronRecords.__init__ again?')
         self._smaker = smaker
         self._mc = mc
@@ -539,7 +565,8 @@ class HeronRecords(Token, Cache):
             context.stats_reporter = self.__stats
             context.browser = self._mc._browser
         elif p is PERM_START_I2B2:
-            st = self._status(badge)
+            # A slow lookup is not a "no" here; wait for every answer.
+            st = self._status(badge, timeouts={})
             if not st.complete:
                 raise NoPermission(st)
             context.start_i2b2 = lambda: self.__redeem(badge)
@@ -547,12 +574,26 @@ class HeronRecords(Token, Cache):
         else:
             raise TypeError
 
-    def _status(self, badge):
-        sponsored = (None if badge.is_investigator()
-                     else
-                     (self._sponsorship(badge.cn) is not None))
+    # seconds to wait for each lookup in _status
+    status_timeouts = dict(sponsorship=10, training=5,
+                           signatures=10, droc=10)
+
+    def _status(self, badge, timeouts=None):
+        '''Look up sponsorship, training, etc. concurrently.
 
-        current_training, expired_training = self._training_current(badge)
+        A lookup that takes longer than its timeout counts as
+        unknown (i.e. no training, not signed, etc.); it's left to
+        finish in the background, which fills the cache for next time.
+
+        :param timeouts: seconds to wait for each lookup, by name;
+                         default :attr:`status_timeouts`. A lookup
+                         missing from timeouts is waited for as long
+                         as it takes.
+        '''
+        def sponsorship():
+            return (None if badge.is_investigator()
+                    else
+                    (self._sponsorship(badge.cn) is not None))
 
         # redcap_connect uses the '%s@%s' pattern when recording
         # signatures, but we have traditionally looked this up
@@ -563,13 +604,26 @@ class HeronRecords(Token, Cache):
         # Cache args have to be hashable
         mailboxes = frozenset([m for m in [badge.mail, cn_at_domain] if m])
 
-        system_access_sigs = [sig.completion_time
-                              for sig in self._signatures(mailboxes)]
-
-        try:
-            droc_audit = self.__oc._droc_auditor(badge)
-        except NotDROC:
-            droc_audit = None
+        def signatures():
+            return [sig.completion_time
+                    for sig in self._signatures(mailboxes)]
+
+        def droc():
+            try:
+                return self.__oc._droc_auditor(badge)
+            except NotDROC:
+                return None
+
+        wait = self.status_timeouts if timeouts is None else timeouts
+        [sponsored,
+         (current_training, expired_training),
+         system_access_sigs,
+         droc_audit] = fanout.gather(self._pool, [
+             ('sponsorship', sponsorship, wait.get('sponsorship'), False),
+             ('training', lambda: self._training_current(badge),
+              wait.get('training'), (None, None)),
+             ('signatures', signatures, wait.get('signatures'), []),
+             ('droc', droc, wait.get('droc'), None)])
 
         # Grace period for training enforcement ends July 1, 2015.
         enforce_training = str(self._t.today()) >= '2015-07-01'
@@ -591,19 +645,29 @@ class HeronRecords(Token, Cache):
                       complete=bool(complete))
 
     def _sponsorship(self, uid,
-                     ttl=timedelta(seconds=600)):
+                     ttl=timedelta(seconds=600),
+                     grace=timedelta(seconds=3600)):
         not_sponsored = timedelta(seconds=1), None
 
         def do_q():
-            for ans in self.__dr.sponsorships(uid):
-                try:
-                    self._mc._browser.lookup(ans.sponsor)
-                except KeyError:
-                    log.warn('Sponsor %s not at med center anymore.',
-                             ans.sponsor)
-                else:
-                    log.info('sponsorship OK: %s', ans)
-                    return ttl, ans
+            size = self.sponsorships_page
+            gone = set()
+            for offset in itertools.count(0, size):
+                page = self.__dr.sponsorships(uid, limit=size, offset=offset)
+                for ans in page:
+                    if ans.sponsor in gone:
+                        continue
+                    try:
+                        self._mc._browser.lookup(ans.sponsor)
+                    except KeyError:
+                        log.warn('Sponsor %s not at med center anymore.',
+                                 ans.sponsor)
+                        gone.add(ans.sponsor)
+                    else:
+                        log.info('sponsorship OK: %s', ans)
+                        return ttl, ans
+                if len(page) < size:
+                    break
 
             log.info('not sponsored: %s', uid)
             return not_sponsored
@@ -612,18 +676,27 @@ class HeronRecords(Token, Cache):
             # Noone is sponsored for identified data
             not_sponsored if self._pm.identified_data
             else
-            self._query(('sponsorship', uid), do_q, 'Sponsorship'))
+            self._query(('sponsorship', uid), do_q, 'Sponsorship',
+                        grace=grace, negative=lambda ans: ans is None))
+
+    def _training_current(self, badge,
+                          ttl=timedelta(seconds=1800)):
+        def do_q():
+            try:
+                return ttl, self._mc.latest_training(badge)
+            except LookupError:
+                log.info('no training on file for: %s (%s)',
+                         badge.cn, badge.full_name())
+                return ttl, None
 
-    def _training_current(self, badge):
         try:
-            info = self._mc.latest_training(badge)
+            info = self._query(('training', badge.cn), do_q, 'Training',
+                               negative=lambda ans: ans is None)
         except (IOError):
             log.warn('failed to look up training due to IOError')
             log.debug('training error detail', exc_info=True)
             return None, None
-        except LookupError:
-            log.info('no training on file for: %s (%s)',
-                     badge.cn, badge.full_name())
+        if info is None:
             return None, None
 
         # convert dates to strings if the database hasn't already
@@ -636,18 +709,20 @@ class HeronRecords(Token, Cache):
 
     def _signatures(self, mailboxes,
                     ttl=timedelta(seconds=15)):
-        '''Look up SAA survey response by email address(es).
+        '''Look up SAA survey response by email address(es),
+        using one query for any that are not cached.
         '''
+        mailboxes = sorted(mailboxes)
 
-        def mkq(mail):
-            def q():
-                return ttl, self._saa_rc.responses(mail)
-            return q
+        def q_many(keys):
+            found = self._saa_rc.responses_many([mail for (_, mail) in keys])
+            return ttl, [found[mail] for (_, mail) in keys]
 
         return [row
-                for mail in mailboxes
-                for row in
-                self._query(('SAA', mail), mkq(mail), 'system access')]
+                for rows in self._query_many([('SAA', mail)
+                                              for mail in mailboxes],
+                                             q_many, 'system access')
+                for row in rows]
 
     def _oversight_request(self, badge):
         log.debug('oversight_request: %s faculty? %s executive? %s',
@@ -725,7 +800,7 @@ class OversightRequest(Token):
         if what_for not in HeronRecords.oversight_request_purposes:
             raise TypeError(what_for)
 
-        tp = team_params(self.__browser.lookup, uids)
+        tp = team_params(self.__browser.lookup_many, uids)
         fac = self.__browser.lookup(fac_id)
         from_faculty = self.__badge.cn == fac_id
         return self.__orc(
@@ -741,11 +816,11 @@ class OversightRequest(Token):
                  multi='yes'), multi=True)
 
 
-def team_params(lookup, uids):
+def team_params(lookup_many, uids):
     r'''
     >>> import pprint
     >>> (mc, ) = medcenter.Mock.make([medcenter.MedCenter])
-    >>> pprint.pprint(list(team_params(mc.peer_badge,
+    >>> pprint.pprint(list(team_params(mc._browser.lookup_many,
     ...                                ['john.smith', 'bill.student'])))
     ... # doctest: +ELLIPSIS
     [('user_id_1', 'john.smith'),
@@ -760,9 +835,8 @@ def team_params(lookup, uids):
                ('team_email_%d' % (i + 1), a.mail),
                ('name_etc_%d' % (i + 1), '%s, %s\n%s\n%s' % (
                    a.sn, a.givenname, a.title or '', a.ou or ''))]
-              for (i, uid, a) in
-              [(i, uids[i], lookup(uids[i]))
-               for i in range(0, len(uids))]]
+              for (i, (uid, a)) in
+              enumerate(zip(uids, lookup_many(uids)))]
     return itertools.chain.from_iterable(nested)
 
 
@@ -799,6 +873,19 @@ class Mock(injector.Module, rtconfig.MockMixin):
     def notary(self, mc):
         return mc.getInspector()
 
+    @provides(KRevalidate)
+    def revalidate(self):
+        # refresh synchronously, i.e. not stale-while-revalidate
+        return None
+
+    @provides(KSharedStore)
+    def shared_store(self):
+        return None
+
+    @provides(fanout.KFanOut)
+    def fanout_pool(self):
+        return fanout.InlinePool()
+
     @classmethod
     def mods(cls):
         log.debug('heron_policy.Mock.mods')
@@ -857,6 +944,18 @@ class RunTime(rtconfig.IniModule):  # pragma nocover
     def notary(self, mc):
         return mc.getInspector()
 
+    @singleton
+    @provides(fanout.KFanOut)
+    def fanout_pool(self):
+        '''Room for each waitress thread to fan out all of
+        :meth:`HeronRecords._status` at once, so that a few slow
+        lookups holding their threads don't starve other requests.
+        '''
+        from multiprocessing.pool import ThreadPool
+        rt = self.get_options(['threads'], 'server:main')
+        threads = int(rt.threads or 4)  # waitress default
+        return ThreadPool(threads * len(HeronRecords.status_timeouts))
+
     @classmethod
     def mods(cls, ini, **kwargs):
         return (
@@ -3,6 +3,7 @@
 '''
 
 import logging
+import threading
 
 import injector
 from injector import inject, provides, singleton
@@ -10,6 +11,7 @@ from sqlalchemy import text, orm, Table, MetaData
 
 import rtconfig
 import ocap_file
+import dbpool
 
 
 log = logging.getLogger(__name__)
@@ -27,6 +29,8 @@ class I2B2Metadata(ocap_file.Token):
         '''
         self._mdsm = metadatasm
         self.i2b2meta_schema = i2b2meta_schema
+        self._reflected = MetaData()
+        self._reflect_lock = threading.Lock()
 
     def project_terms(self, i2b2_pid, rc_pids,
                       rct_table='REDCAP_TERMS'):
@@ -44,8 +48,7 @@ class I2B2Metadata(ocap_file.Token):
         # ... and insert only redcap_terms
         mds.execute('''DELETE FROM %s.%s''' % (schema, rct_table))
 
-        rct = Table(rct_table, MetaData(), schema=schema, autoload=True,
-                    autoload_with=mds.bind)
+        rct = self._table(mds.bind, schema, rct_table)
 
         insert_cmd, params = insert_for(self.i2b2meta_schema, pid, schema,
                                         rc_pids,
@@ -56,6 +59,35 @@ class I2B2Metadata(ocap_file.Token):
 
         mds.commit()
 
+    def _table(self, bind, schema, name):
+        '''Reflect a table, once per schema.
+
+        >>> from sqlite_mem import _test_engine
+        >>> db = _test_engine()
+        >>> db.execute('create table REDCAP_TERMS (c_name, c_basecode)')
+        ... # doctest: +ELLIPSIS
+        <sqlalchemy.engine.result.ResultProxy object at ...>
+        >>> md = I2B2Metadata(None, 'bhmetadataB2')
+        >>> [c.name for c in md._table(db, 'main', 'REDCAP_TERMS').columns]
+        ['c_name', 'c_basecode']
+
+        Later changes to the table go unnoticed; that's the point:
+
+        >>> db.execute('alter table REDCAP_TERMS add column c_tooltip')
+        ... # doctest: +ELLIPSIS
+        <sqlalchemy.engine.result.ResultProxy object at ...>
+        >>> [c.name for c in md._table(db, 'main', 'REDCAP_TERMS').columns]
+        ['c_name', 'c_basecode']
+        '''
+        key = '%s.%s' % (schema, name)
+        with self._reflect_lock:
+            table = self._reflected.tables.get(key)
+            if table is None:
+                log.info('reflecting %s', key)
+                table = Table(name, self._reflected, schema=schema,
+                              autoload=True, autoload_with=bind)
+        return table
+
     def rc_in_i2b2(self, rc_pids):
         """Find out which REDCap projects are in HERON.
 
@@ -169,18 +201,27 @@ class RunTime(rtconfig.IniModule):
 
     @singleton
     @provides((orm.session.Session, CONFIG_SECTION_MD))
-    def md_sessionmaker(self):
+    @inject(pools=dbpool.PoolStats)
+    def md_sessionmaker(self, pools):
+        sm = orm.session.sessionmaker()
+
+        def make_engine():
+            engine_opts = self.get_options(['i2b2meta_url'] +
+                                           dbpool.POOL_OPTIONS,
+                                           CONFIG_SECTION_MD)
+            search_path = '-csearch_path={}'.format(self.i2b2meta_schema())
+            return self.__create_engine(engine_opts.i2b2meta_url,
+                                        connect_args={'options': search_path},
+                                        **dbpool.pool_kwargs(engine_opts))
+        engine = dbpool.SharedEngine(CONFIG_SECTION_MD, make_engine, pools)
+
         def send_sessionmaker():
-            sm = orm.session.sessionmaker()
-            engine_opts = self.get_options(['i2b2meta_url'], CONFIG_SECTION_MD)
-            engine = self.__create_engine(engine_opts.i2b2meta_url, connect_args={'options': '-csearch_path={}'.format(self.i2b2meta_schema())})
-            ds = sm(bind=engine)
-            return ds
+            return sm(bind=engine())
         return send_sessionmaker
 
     @provides(Ki2b2meta_schema)
     def i2b2meta_schema(self):
-        rt = self.get_options(['i2b2meta_schema'], CONFIG_SECTION_MD)
+        rt = self.get_options(['i2b2meta_schema'], CONFIG_SECTION_MD)
         meta_schema = rt.i2b2meta_schema
         log.info('i2b2meta_schema: %s', meta_schema)
         return meta_schema
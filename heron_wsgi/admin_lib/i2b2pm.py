@@ -182,10 +182,11 @@ left static.
 
 import logging
 import hashlib
+import threading
 
 import injector
 from injector import inject, provides, singleton
-from sqlalchemy import Column, ForeignKey, and_
+from sqlalchemy import Column, ForeignKey, Index, and_, select
 from sqlalchemy import func, orm
 from sqlalchemy.types import String, DateTime, Enum
 from sqlalchemy.ext.declarative import declarative_base
@@ -193,6 +194,7 @@ from sqlalchemy.ext.declarative import declarative_base
 import rtconfig
 import ocap_file
 import i2b2metadata
+import dbpool
 from sqlite_mem import _test_engine
 
 CONFIG_SECTION = 'i2b2pm'
@@ -366,21 +368,105 @@ def hexdigest(txt):
     return ''.join([hex(ord(b))[2:] for b in hashlib.md5(txt).digest()])
 
 
-def revoke_expired_auths(ds):
-    '''Revoke one-time passwords for all users whose sessions are expired.
+def revoke_expired_auths(ds, batch_size=500, now=None):
+    '''Revoke one-time passwords for users whose sessions are all expired.
+
+    Users whose latest session has expired are found in one grouped
+    pass over `pm_user_session` (served by the index on
+    `(user_id, expired_date)` in `i2b2pm_indexes.sql`, which
+    i2b2 doesn't create itself), rather than a correlated subquery per
+    `pm_user_data` row; their passwords are cleared `batch_size`
+    at a time, so that no one statement holds many locks.
+
+    >>> from datetime import datetime
+    >>> (sm, ) = Mock.make([(orm.session.Session, CONFIG_SECTION)])
+    >>> ds = sm()
+    >>> for uid, until in [('old.login', datetime(2011, 1, 1)),
+    ...                    ('new.login', datetime(2999, 1, 1)),
+    ...                    ('OBFSC_SERVICE_ACCOUNT', datetime(2011, 1, 1))]:
+    ...     ds.add(User(user_id=uid, password='sekret'))
+    ...     ds.add(UserSession(user_id=uid, expired_date=until))
+    >>> ds.commit()
+
+    >>> revoke_expired_auths(ds)
+    1
+    >>> ds.execute('select user_id, password from pm_user_data'
+    ...            ' order by user_id').fetchall()
+    ... # doctest: +NORMALIZE_WHITESPACE
+    [(u'OBFSC_SERVICE_ACCOUNT', u'sekret'), (u'new.login', u'sekret'),
+     (u'old.login', None)]
+    >>> revoke_expired_auths(ds)
+    0
+
+    :param now: defaults to the database's `current_timestamp`
+    :return: how many passwords were revoked
     '''
-    ds.execute('''
-    update pm_user_data
-    set password = null
-    where
-        user_id not like '%SERVICE_ACCOUNT'
-        and user_id != 'jenkins'
-        and password is not null and (
-        select max(ipus.expired_date)
-        from pm_user_session ipus
-        where ipus.user_id = user_id) < current_timestamp
-    ''')
-    ds.commit()
+    pu, ps = User.__table__, UserSession.__table__
+    now = func.current_timestamp() if now is None else now
+    expired = select([ps.c.user_id]).\
+        group_by(ps.c.user_id).\
+        having(func.max(ps.c.expired_date) < now)
+    candidates = select([pu.c.user_id]).\
+        where(and_(pu.c.password != None,  # noqa
+                   ~pu.c.user_id.like('%SERVICE_ACCOUNT'),
+                   pu.c.user_id != 'jenkins',
+                   pu.c.user_id.in_(expired))).\
+        limit(batch_size)
+
+    total = 0
+    while True:
+        batch = [uid for (uid, ) in ds.execute(candidates).fetchall()]
+        if batch:
+            ds.execute(pu.update().
+                       where(pu.c.user_id.in_(batch)).
+                       values(password=None))
+            ds.commit()
+            total += len(batch)
+        if len(batch) < batch_size:
+            break
+    return total
+
+
+class AuthRevoker(object):
+    '''Revoke expired one-time passwords periodically, off the request path.
+
+    >>> (sm, ) = Mock.make([(orm.session.Session, CONFIG_SECTION)])
+    >>> AuthRevoker(sm, interval=60).run_once()
+    0
+    '''
+    def __init__(self, datasrc, interval=300, batch_size=500):
+        self.__datasrc = datasrc
+        self.interval = interval
+        self.batch_size = batch_size
+        self.__stop = threading.Event()
+
+    def run_once(self):
+        ds = self.__datasrc()
+        try:
+            qty = revoke_expired_auths(ds, self.batch_size)
+        finally:
+            ds.close()
+        if qty:
+            log.info('revoked %d expired i2b2 authorizations', qty)
+        return qty
+
+    def start(self):
+        t = threading.Thread(target=self._loop, name='i2b2pm.AuthRevoker')
+        t.daemon = True
+        t.start()
+        return t
+
+    def stop(self):
+        self.__stop.set()
+
+    def _loop(self):
+        while not self.__stop.is_set():
+            try:
+                self.run_once()
+            except Exception:
+                log.warn('revoking expired authorizations failed',
+                         exc_info=True)
+            self.__stop.wait(self.interval)
 
 
 def proj_desc_for(rc_pids):
@@ -449,6 +535,9 @@ class UserRole(Base, Audited):
 
 class UserSession(Base, Audited):
     __tablename__ = 'pm_user_session'
+    # not part of i2b2; see i2b2pm_indexes.sql
+    __table_args__ = (Index('pm_user_session_user_expired',
+                            'user_id', 'expired_date'), )
 
     user_id = Column(String,
                      ForeignKey('pm_user_data.user_id'),
@@ -481,24 +570,42 @@ class RunTime(rtconfig.IniModule):  # pragma: nocover
 
     # abusing Session a bit; this really provides a subclass, not an
     # instance, of Session
-    def sessionmaker(self, jndi, section):
+    def sessionmaker(self, jndi, section, pools=None):
 
         sm = orm.session.sessionmaker()
 
-        def make_session_and_revoke():
-            engine_opts = self.get_options(['i2b2pm_url'], CONFIG_SECTION)
+        def make_engine():
+            engine_opts = self.get_options(['i2b2pm_url'] +
+                                           dbpool.POOL_OPTIONS,
+                                           CONFIG_SECTION)
             log.info('i2p2pm engine: %s', engine_opts.i2b2pm_url)
-            engine = self.__create_engine(engine_opts.i2b2pm_url, connect_args={'options': '-csearch_path={}'.format(self.i2b2pm_schema())})
-            ds = sm(bind=engine)
-            revoke_expired_auths(ds)
-            return ds
+            search_path = '-csearch_path={}'.format(self.i2b2pm_schema())
+            return self.__create_engine(engine_opts.i2b2pm_url,
+                                        connect_args={'options': search_path},
+                                        **dbpool.pool_kwargs(engine_opts))
+        engine = dbpool.SharedEngine(section, make_engine, pools)
+
+        # Expired authorizations are revoked by AuthRevoker, not here.
+        def make_session():
+            return sm(bind=engine())
 
-        return make_session_and_revoke
+        return make_session
 
     @singleton
     @provides((orm.session.Session, CONFIG_SECTION))
-    def pm_sessionmaker(self):
-        return self.sessionmaker(self.jndi_name, CONFIG_SECTION)
+    @inject(pools=dbpool.PoolStats)
+    def pm_sessionmaker(self, pools):
+        return self.sessionmaker(self.jndi_name, CONFIG_SECTION, pools)
+
+    @singleton
+    @provides(AuthRevoker)
+    @inject(datasrc=(orm.session.Session, CONFIG_SECTION))
+    def revoker(self, datasrc):
+        rt = self.get_options(['revoke_interval', 'revoke_batch_size'],
+                              CONFIG_SECTION)
+        return AuthRevoker(datasrc,
+                           interval=int(rt.revoke_interval or 300),
+                           batch_size=int(rt.revoke_batch_size or 500))
 
     @singleton
     @provides(i2b2metadata.I2B2Metadata)
@@ -0,0 +1,8 @@
+-- Indexes for queries that heron_wsgi makes of the i2b2 PM schema.
+-- i2b2 doesn't ship these; run once per PM database, with the
+-- i2b2pm_schema from the [i2b2pm] config section as the search_path:
+--   PGOPTIONS=-csearch_path=i2b2pm psql -f i2b2pm_indexes.sql
+
+-- i2b2pm.revoke_expired_auths finds each user's latest session
+create index if not exists pm_user_session_user_expired
+  on pm_user_session (user_id, expired_date);
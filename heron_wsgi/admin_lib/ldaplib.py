@@ -26,6 +26,73 @@ Caching:
   INFO:cache_remote:LDAP query for ('(cn=john.smith)', ('sn',))
   INFO:cache_remote:... cached until 2011-09-02 00:00:08.500000
 
+Several cns can be looked up in one search; those already cached
+are not searched again::
+
+  >>> ds.search_cns(['john.smith', 'nobody', 'bill.student'], ['sn'])
+  ... # doctest: +NORMALIZE_WHITESPACE
+  [[('(cn=john.smith)', {'sn': ['Smith']})],
+   [],
+   [('(cn=bill.student)', {'sn': ['Student']})]]
+  >>> print(logged())
+  ... # doctest: +NORMALIZE_WHITESPACE
+  INFO:cache_remote:LDAP query for [('(cn=nobody)', ('sn',)),
+                                    ('(cn=bill.student)', ('sn',))]
+  INFO:cache_remote:... cached until 2011-09-02 00:00:09
+  >>> ds.search_cn('bill.student', ['sn'])
+  [('(cn=bill.student)', {'sn': ['Student']})]
+  >>> print(logged())
+  <BLANKLINE>
+
+Connection Pool
+---------------
+
+Request threads share a pool of bound connections::
+
+  >>> server = MockLDAP()
+  >>> ds = LDAPService(ts.now, ttl=2, rt=_sample_settings,
+  ...                  ldap=server, flags=MockLDAP, pool_size=2)
+  >>> [len(ds.search_cn(cn, ['sn'])) for cn in ['john.smith', 'big.wig']]
+  [1, 1]
+  >>> server.binds
+  1
+
+When the server drops its connections, we bind again and retry::
+
+  >>> server.drop()
+  >>> ds.search_cn('bill.student', ['sn'])
+  [('(cn=bill.student)', {'sn': ['Student']})]
+  >>> server.binds
+  2
+
+Connections that have been idle a while are checked before use::
+
+  >>> ds = LDAPService(ts.now, ttl=2, rt=_sample_settings,
+  ...                  ldap=server, flags=MockLDAP, check_after=0)
+  >>> [len(ds.search_cn(cn, ['sn'])) for cn in ['john.smith', 'big.wig']]
+  [1, 1]
+  >>> server.whoamis, server.binds
+  (1, 3)
+  >>> server.drop()
+  >>> len(ds.search_cn('bill.student', ['sn']))
+  1
+  >>> server.whoamis, server.binds
+  (1, 4)
+
+With `async_search`, batches of searches are in flight at once,
+using the asynchronous search / result API::
+
+  >>> slow = MockLDAP(latency=0.01)
+  >>> ds = LDAPService(ts.now, ttl=2, rt=_sample_settings,
+  ...                  ldap=slow, flags=MockLDAP, async_search=True)
+  >>> [len(found) for found in ds.search_cns(
+  ...     ['john.smith', 'big.wig', 'some.one', 'nobody'], ['sn'],
+  ...     chunk_size=1)]
+  [1, 1, 1, 0]
+  >>> slow.peak_in_flight
+  4
+  >>> _ = logged()
+
 Sample configuration::
 
   >>> print(_sample_settings.inifmt(CONFIG_SECTION))
@@ -65,14 +132,19 @@ from datetime import datetime
 from datetime import timedelta
 from io import BytesIO
 from pprint import pformat
+import contextlib
 import csv
+import itertools
 import logging
 import re
+import threading
+import time
 
 import pkg_resources as pkg  # type: ignore
 from injector import inject, provides, singleton  # type: ignore
 
-from cache_remote import Cache
+from cache_remote import Cache, CacheStats, KRevalidate, KSharedStore
+from cache_remote import background
 from ocap_file import Path
 import rtconfig
 
@@ -91,16 +163,32 @@ class LDAPService(Cache):
                  ttl,   # type: int
                  rt,    # type: py.Any
                  ldap,  # type: py.Any
-                 flags  # type: py.Any
+                 flags,  # type: py.Any
+                 grace=None,  # type: py.Optional[int]
+                 revalidate=None,  # type: py.Optional[py.Callable]
+                 negative_ttl=None,  # type: py.Optional[int]
+                 stats=None,  # type: py.Optional[CacheStats]
+                 store=None,  # type: py.Any
+                 pool_size=4,  # type: int
+                 check_after=60,  # type: float
+                 pool_wait=30,  # type: float
+                 async_search=False  # type: bool
                  ):
         # type: (...) -> None
-        Cache.__init__(self, now)
+        Cache.__init__(self, now, revalidate=revalidate,
+                       negative_ttl=(timedelta(seconds=negative_ttl)
+                                     if negative_ttl else None),
+                       stats=stats, store=store)
         self._ttl = timedelta(seconds=ttl)
+        self._grace = timedelta(seconds=grace) if grace else None
         datetime  # tell flycheck we're using it
         self._rt = rt
         self._ldap = ldap
         self.flags = flags
-        self._l = None
+        self._pool = ConnectionPool(self._bind, pool_size, flags.SERVER_DOWN,
+                                    check_after=check_after,
+                                    wait=pool_wait)
+        self._async = async_search
 
     def search_cn(self, cn, attrs):
         # type: (str, py.List[str]) -> py.List[Result]
@@ -129,18 +217,97 @@ class LDAPService(Cache):
         return self._query((query, attrs_t),
                            lambda: (self._ttl,
                                     self.search_remote(query, attrs)),
-                           'LDAP')
+                           'LDAP', grace=self._grace,
+                           negative=lambda results: not results)
+
+    def search_cns(self, cns, attrs, chunk_size=50):
+        # type: (py.List[str], py.List[str], int) -> py.List[py.List[Result]]
+        '''Search for each of several cns, in as few searches as we can.
+
+        :return: a list of results per cn, as from :meth:`search_cn`
+        '''
+        attrs_t = tuple(sorted(attrs))
+        fetch_attrs = list(attrs) if 'cn' in attrs else list(attrs) + ['cn']
+
+        def fetch(keys):
+            # type: (py.List[py.Tuple[str, py.Tuple[str, ...]]]) -> py.Any
+            queries = ['(|%s)' % ''.join(q for (q, _) in
+                                         keys[ix:ix + chunk_size])
+                       for ix in range(0, len(keys), chunk_size)]
+            results = (self.search_remote_many(queries, fetch_attrs)
+                       if self._async else
+                       [self.search_remote(q, fetch_attrs) for q in queries])
+            by_cn = {}  # type: py.Dict[str, py.List[Result]]
+            for dn, found in itertools.chain.from_iterable(results):
+                ans = (dn, found if 'cn' in attrs else
+                       dict((n, v) for (n, v) in found.items()
+                            if n != 'cn'))
+                for cn in found.get('cn', []):
+                    by_cn.setdefault(cn.lower(), []).append(ans)
+            return self._ttl, [by_cn.get(cn_of[k].lower(), [])
+                               for k in keys]
+
+        keys = [('(cn=%s)' % quote(cn), attrs_t) for cn in cns]
+        cn_of = dict(zip(keys, cns))
+        return self._query_many(keys, fetch, 'LDAP',
+                                negative=lambda results: not results)
 
     def search_remote(self, query, attrs):
         # type: (str, py.List[str]) -> py.List[Result]
-        ds = self._l or self._bind()
-        base = self._rt.base
+        return self._on_connection(
+            lambda ds: ds.search_s(self._rt.base, self.flags.SCOPE_SUBTREE,
+                                   query, attrs))
+
+    def search_remote_many(self, queries, attrs):
+        # type: (py.List[str], py.List[str]) -> py.List[py.List[Result]]
+        '''Put several searches in flight at once; collect the results.
+        '''
+        def search_all(ds):
+            # type: (py.Any) -> py.List[py.List[Result]]
+            msgids = [ds.search(self._rt.base, self.flags.SCOPE_SUBTREE,
+                                q, attrs)
+                      for q in queries]
+            return [ds.result(msgid, 1)[1] for msgid in msgids]
+        return self._on_connection(search_all)
+
+    def search_remote_paged(self, query, attrs, base=None, page_size=500):
+        # type: (str, py.List[str], py.Optional[str], int) -> py.List[Result]
+        '''Search page by page, as for a dump of the whole directory.
+
+        Paging cookies are good only on the connection that issued
+        them, so this binds a connection of its own rather than
+        holding one from the pool for the whole search.
+
+        :param base: search base; default: the configured `base`
+        '''
+        paging = self.flags.controls.SimplePagedResultsControl(
+            True, size=page_size, cookie='')
+        ds = self._bind()
         try:
-            ans = ds.search_s(base, self.flags.SCOPE_SUBTREE, query, attrs)
+            found = []  # type: py.List[Result]
+            while True:
+                msgid = ds.search_ext(base or self._rt.base,
+                                      self.flags.SCOPE_SUBTREE,
+                                      query, attrs, serverctrls=[paging])
+                _, page, _, controls = ds.result3(msgid)
+                found.extend(page)
+                cookies = [c.cookie for c in controls
+                           if c.controlType == paging.controlType]
+                if not (cookies and cookies[0]):
+                    return found
+                paging.cookie = cookies[0]
+        finally:
+            ds.unbind_s()
+
+    def _on_connection(self, work):
+        # type: (py.Callable[[py.Any], py.Any]) -> py.Any
+        try:
+            with self._pool.connection() as ds:
+                return work(ds)
         except self.flags.SERVER_DOWN:
-            self._l = ds = self._bind()
-            ans = ds.search_s(base, self.flags.SCOPE_SUBTREE, query, attrs)
-        return ans
+            log.warn('LDAP server down; retrying on a new connection')
+            with self._pool.connection() as ds:
+                return work(ds)
 
     def _bind(self):
         # type: () -> py.Any
@@ -152,6 +319,129 @@ class LDAPService(Cache):
         return ds
 
 
+class PoolExhausted(IOError):
+    '''No pooled connection came free in time.
+    '''
+
+
+class ConnectionPool(object):
+    '''Thread-safe pool of bound connections.
+
+    :param connect: thunk to make a bound connection
+    :param size: most connections to keep at once
+    :param down: exception that means a connection is no good
+    :param check_after: check connections idle this many seconds
+                        (using `whoami_s()`) before using them
+    :param wait: give up (with `PoolExhausted`) after waiting
+                 this many seconds for a connection
+
+    A connection that fails its check for any other reason gives
+    up its slot::
+
+      >>> class Flaky(object):
+      ...     def whoami_s(self):
+      ...         raise IOError('timed out')
+      >>> pool = ConnectionPool(Flaky, 1, MockLDAP.SERVER_DOWN,
+      ...                       check_after=0, wait=0.01)
+      >>> with pool.connection():
+      ...     pass
+      >>> with pool.connection():
+      ...     pass
+      Traceback (most recent call last):
+        ...
+      IOError: timed out
+      >>> with pool.connection():
+      ...     pass
+
+    When every connection is in use, callers wait only so long::
+
+      >>> pool = ConnectionPool(object, 1, MockLDAP.SERVER_DOWN, wait=0.01)
+      >>> with pool.connection():
+      ...     with pool.connection():
+      ...         pass
+      Traceback (most recent call last):
+        ...
+      PoolExhausted: no LDAP connection free after 0.01 sec
+    '''
+    def __init__(self, connect, size, down, check_after=60, wait=30,
+                 clock=time.time):
+        self.__connect = connect
+        self.size = size
+        self.__down = down
+        self.check_after = check_after
+        self.wait = wait
+        self.__clock = clock
+        self.__idle = []  # (last used, connection), most recent last
+        self.__qty = 0
+        self.__ready = threading.Condition()
+
+    @contextlib.contextmanager
+    def connection(self):
+        conn = self._checkout()
+        try:
+            yield conn
+        except self.__down:
+            self._discard(everything=True)
+            raise
+        except:  # noqa
+            self._checkin(conn)
+            raise
+        else:
+            self._checkin(conn)
+
+    def _checkout(self):
+        while True:
+            with self.__ready:
+                deadline = time.time() + self.wait
+                while not self.__idle and self.__qty >= self.size:
+                    left = deadline - time.time()
+                    if left <= 0:
+                        raise PoolExhausted(
+                            'no LDAP connection free after %s sec' %
+                            self.wait)
+                    self.__ready.wait(left)
+                if self.__idle:
+                    last_used, conn = self.__idle.pop()
+                else:
+                    self.__qty += 1
+                    last_used, conn = None, None
+
+            if conn is None:
+                try:
+                    return self.__connect()
+                except:  # noqa
+                    self._discard()
+                    raise
+
+            if self.__clock() - last_used < self.check_after:
+                return conn
+            try:
+                conn.whoami_s()
+                return conn
+            except self.__down:
+                log.info('discarding stale LDAP connection')
+                self._discard(everything=True)
+            except:  # noqa
+                self._discard()
+                raise
+
+    def _checkin(self, conn):
+        with self.__ready:
+            self.__idle.append((self.__clock(), conn))
+            self.__ready.notify()
+
+    def _discard(self, everything=False):
+        '''Forget a checked out connection and, if the server went down,
+        idle ones as well.
+        '''
+        with self.__ready:
+            self.__qty -= 1
+            if everything:
+                self.__qty -= len(self.__idle)
+                self.__idle = []
+            self.__ready.notify_all()
+
+
 def quote(txt):
     r'''
     examples from `section 4 of RFC4515`__
@@ -178,41 +468,78 @@ def quote(txt):
 
 
 class MockLDAP(object):
+    '''Mock LDAP server, with optional latency and dropped connections.
+    '''
     SCOPE_SUBTREE, OPT_X_TLS_CACERTFILE = range(2)
+    RES_SEARCH_RESULT = 101
 
     class SERVER_DOWN(Exception):
         pass
 
-    def __init__(self, records=None):
+    class controls(object):
+        class SimplePagedResultsControl(object):
+            controlType = '1.2.840.113556.1.4.319'
+
+            def __init__(self, criticality, size, cookie):
+                self.criticality = criticality
+                self.size = size
+                self.cookie = cookie
+
+    def __init__(self, records=None, latency=0):
         if records is None:
             records = MockDirectory().records
         self._d = dict([(r['cn'], r) for r in records])
-        self._bound = False
+        self.latency = latency
+        self.binds = 0
+        self.whoamis = 0
+        self.pages = 0
+        self.in_flight = self.peak_in_flight = 0
+        self._generation = 0
+        self._lock = threading.Lock()
 
     def set_option(self, option, invalue):
         assert option == self.OPT_X_TLS_CACERTFILE
         assert invalue == _sample_settings.certfile
 
     def initialize(self, url):
-        return self
+        return _MockConnection(self)
 
-    def simple_bind_s(self, username, password):
-        self._bound = True
+    def drop(self):
+        '''Drop all connections, as when the server restarts.
+        '''
+        self._generation += 1
 
-    def search_s(self, base, scope, q, attrs):
-        if not self._bound:
-            raise TypeError('not bound')
+    def _begin(self):
+        with self._lock:
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
 
+    def _end(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    def _answer(self, q, attrs):
         log.debug('network fetch for %s', q)  # TODO: caching, .info()
-        i = self._qid(q)
-        try:
-            record = self._d[i]
-        except KeyError:
-            return []
+        since = re.search(r'\(modifyTimestamp>=([^)]+)\)', q)
+        ids = (re.findall(r'\(cn=([^*)]+)\)', q) if q.startswith('(|')
+               else sorted(self._d.keys()) if q.startswith('(cn=*)') or
+               q.startswith('(&(cn=*)')
+               else [self._qid(q)])
         return [('(cn=%s)' % i,
                  dict([(a, [record[a]])
                        for a in (attrs or record.keys())
-                       if record[a] != '']))]
+                       if record.get(a, '') != '']))
+                for i in ids
+                for record in [self._d.get(i)]
+                if record and (not since or
+                               record.get('modifyTimestamp', '') >=
+                               since.group(1))]
+
+    def update(self, cn, modifyTimestamp, **attrs):
+        '''Change a directory entry, as of modifyTimestamp.
+        '''
+        self._d[cn] = dict(self._d[cn], modifyTimestamp=modifyTimestamp,
+                           **attrs)
 
     @classmethod
     def _qid(cls, q):
@@ -229,6 +556,71 @@ class MockLDAP(object):
         raise ValueError
 
 
+class _MockConnection(object):
+    def __init__(self, server):
+        self._server = server
+        self._generation = server._generation
+        self._bound = False
+        self._msgids = itertools.count(1)
+        self._pending = {}
+
+    def _check(self):
+        if self._generation != self._server._generation:
+            raise self._server.SERVER_DOWN()
+
+    def simple_bind_s(self, username, password):
+        self._check()
+        self._bound = True
+        self._server.binds += 1
+
+    def whoami_s(self):
+        self._check()
+        self._server.whoamis += 1
+        return 'dn:' + _sample_settings.userdn
+
+    def search_s(self, base, scope, q, attrs):
+        return self.result(self.search(base, scope, q, attrs))[1]
+
+    def search(self, base, scope, q, attrs):
+        self._check()
+        if not self._bound:
+            raise TypeError('not bound')
+        self._server._begin()
+        msgid = next(self._msgids)
+        self._pending[msgid] = (time.time(), q, attrs)
+        return msgid
+
+    def result(self, msgid, all=1, timeout=None):
+        started, q, attrs = self._pending.pop(msgid)
+        try:
+            time.sleep(max(0, started + self._server.latency - time.time()))
+            self._check()
+            return (self._server.RES_SEARCH_RESULT,
+                    self._server._answer(q, attrs))
+        finally:
+            self._server._end()
+
+    def search_ext(self, base, scope, q, attrs, serverctrls):
+        [paging] = serverctrls
+        msgid = self.search(base, scope, q, attrs)
+        self._paging = msgid, paging
+        return msgid
+
+    def result3(self, msgid):
+        rtype, found = self.result(msgid)
+        pmsgid, paging = self._paging
+        assert pmsgid == msgid
+        start = int(paging.cookie or 0)
+        end = start + paging.size
+        self._server.pages += 1
+        more = paging.__class__(False, size=0,
+                                cookie=str(end) if end < len(found) else '')
+        return rtype, found[start:end], msgid, [more]
+
+    def unbind_s(self):
+        self._bound = False
+
+
 _sample_settings = rtconfig.TestTimeOptions(dict(
     certfile='LDAP_HOST_CERT.pem',
     url='ldaps://_ldap_host_:636',
@@ -270,15 +662,25 @@ class RunTime(rtconfig.IniModule):  # pragma: nocover
         return self.get_options(
             ('url certfile userdn base password'
              ' studylookupaddr'
-             ' executives testing_faculty').split(),
+             ' executives testing_faculty'
+             ' cache_grace cache_negative_ttl'
+             ' pool_size pool_wait async_search'
+             ' snapshot_interval snapshot_base snapshot_filter').split(),
             CONFIG_SECTION)
 
+    @provides(KRevalidate)
+    def revalidate(self):
+        return background
+
     @singleton
     @provides(LDAPService)
     @inject(rt=(rtconfig.Options, CONFIG_SECTION),
-            timesrc=rtconfig.Clock)
-    def service(self, rt, timesrc,
-                ttl=15):
+            timesrc=rtconfig.Clock,
+            revalidate=KRevalidate,
+            stats=CacheStats,
+            store=KSharedStore)
+    def service(self, rt, timesrc, revalidate, stats, store,
+                ttl=15, grace=300, negative_ttl=300):
         '''Provide native or mock LDAP implementation.
 
         This is demand-loaded so that the codebase can be tested
@@ -288,14 +690,37 @@ class RunTime(rtconfig.IniModule):  # pragma: nocover
 
         __ http://www.python-ldap.org/doc/html/ldap.html
 
+        Directory entries are served for up to `cache_grace` seconds
+        (default: 300) past their ttl while they are refreshed in the
+        background; use `cache_grace=0` to turn this off.
+
+        Searches that find nothing, such as for departed staff,
+        are remembered for `cache_negative_ttl` seconds (default: 300).
+
+        Up to `pool_size` (default: 4) connections are kept bound;
+        a search waits at most `pool_wait` seconds (default: 30)
+        for one to come free;
+        `async_search=true` lets batches of searches be in flight at once.
         '''
         flags = self.__ldap
+        if rt.cache_grace is not None:
+            grace = int(rt.cache_grace)
+        if rt.cache_negative_ttl is not None:
+            negative_ttl = int(rt.cache_negative_ttl)
         return LDAPService(timesrc.now, ttl=ttl, rt=rt,
-                           ldap=self.__ldap, flags=flags)
+                           ldap=self.__ldap, flags=flags,
+                           grace=grace, revalidate=revalidate,
+                           negative_ttl=negative_ttl, stats=stats,
+                           store=store,
+                           pool_size=int(rt.pool_size or 4),
+                           pool_wait=float(rt.pool_wait or 30),
+                           async_search=(rt.async_search or '').lower()
+                           in ('1', 'true'))
 
     @classmethod
     def mods(cls, ini, ldap, timesrc, **kwargs):
-        return [cls(ini, ldap), rtconfig.RealClockInjector(timesrc)]
+        return [cls(ini, ldap), rtconfig.RealClockInjector(timesrc),
+                rtconfig.SharedCacheInjector(ini)]
 
 
 if __name__ == '__main__':  # pragma nocover
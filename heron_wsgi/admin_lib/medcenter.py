@@ -95,6 +95,8 @@ import logging
 import injector
 from injector import inject, provides, singleton
 
+from cache_remote import CacheStats
+from dirsnapshot import DirectorySnapshot
 import rtconfig
 import ldaplib
 import sealing
@@ -136,6 +138,19 @@ class Browser(object):
         ....
       KeyError: 'nobody-by-this-cn'
 
+    Look up several people at once:
+
+      >>> m.lookup_many(['bill.student', 'john.smith'])
+      ... # doctest: +NORMALIZE_WHITESPACE
+      [Bill Student <bill.student@js.example>,
+       John Smith <john.smith@js.example>]
+      >>> m.lookup_many(['john.smith', 'nobody-by-this-cn'], strict=False)
+      [John Smith <john.smith@js.example>, None]
+      >>> m.lookup_many(['john.smith', 'nobody-by-this-cn'])
+      Traceback (most recent call last):
+        ....
+      KeyError: 'nobody-by-this-cn'
+
 
     Nonsense input:
 
@@ -147,10 +162,12 @@ class Browser(object):
 
     '''
     @inject(searchsvc=ldaplib.LDAPService,
-            studyLookup=KStudyTeamLookup)
-    def __init__(self, searchsvc, studyLookup):
+            studyLookup=KStudyTeamLookup,
+            names=DirectorySnapshot)
+    def __init__(self, searchsvc, studyLookup, names):
         self._svc = searchsvc
         self._studyLookup = studyLookup
+        self._names = names
 
     def directory_attributes(self, name):
         '''Get directory attributes.
@@ -167,14 +184,35 @@ class Browser(object):
         return LDAPBadge._simplify(ldapattrs)
 
     def _search(self, max_qty, cn, sn, givenname):
-        return self._svc.search_name_clues(max_qty, cn, sn, givenname,
-                                           Badge.attributes)
+        return self._names.search_name_clues(max_qty, cn, sn, givenname,
+                                             Badge.attributes)
 
     def lookup(self, name):
         '''Get a badge for a peer, i.e. with no authority.
         '''
         return LDAPBadge(**self.directory_attributes(name))
 
+    def lookup_many(self, names, strict=True):
+        '''Get badges for several peers, using one directory search.
+
+        :param strict: raise KeyError for any name not found, as
+                       :meth:`lookup` does; otherwise, use None.
+        '''
+        badges = []
+        for name, matches in zip(names,
+                                 self._svc.search_cns(names,
+                                                      Badge.attributes)):
+            if len(matches) != 1:  # pragma nocover
+                if len(matches) > 1:
+                    raise ValueError(name)  # ambiguous
+                elif strict:
+                    raise KeyError(name)
+                badges.append(None)
+                continue
+            dn, ldapattrs = matches[0]
+            badges.append(LDAPBadge(**LDAPBadge._simplify(ldapattrs)))
+        return badges
+
     def search(self, max_qty, cn, sn, givenname):
         '''Search for peers.
         '''
@@ -428,13 +466,20 @@ class Mock(injector.Module, rtconfig.MockMixin):
 
     '''
 
+    @singleton
     @provides(ldaplib.LDAPService)
-    @inject(d=ldaplib.MockDirectory, ts=rtconfig.Clock)
-    def ldap(self, d, ts):
+    @inject(d=ldaplib.MockDirectory, ts=rtconfig.Clock,
+            stats=CacheStats)
+    def ldap(self, d, ts, stats):
         return ldaplib.LDAPService(
             ts.now, ttl=2, rt=ldaplib._sample_settings,
             ldap=ldaplib.MockLDAP(d.records),
-            flags=ldaplib.MockLDAP)
+            flags=ldaplib.MockLDAP, stats=stats)
+
+    @provides(DirectorySnapshot)
+    @inject(svc=ldaplib.LDAPService)
+    def names(self, svc):
+        return DirectorySnapshot(svc, Badge.attributes)
 
     @provides(rtconfig.Clock)
     def _time_source(self):
@@ -496,6 +541,23 @@ class RunTime(rtconfig.IniModule):  # pragma: nocover
     def training(self):
         return self.__trainingfn
 
+    @singleton
+    @provides(DirectorySnapshot)
+    @inject(rt=(rtconfig.Options, ldaplib.CONFIG_SECTION),
+            svc=ldaplib.LDAPService)
+    def names(self, rt, svc):
+        '''Answer team member searches from a directory snapshot
+        refreshed every `snapshot_interval` seconds, if set.
+
+        The snapshot holds entries under `snapshot_base` (default:
+        `base`) that match `snapshot_filter` (default: `(cn=*)`).
+        '''
+        return DirectorySnapshot(
+            svc, Badge.attributes,
+            interval=int(rt.snapshot_interval or 0) or None,
+            query=rt.snapshot_filter or '(cn=*)',
+            base=rt.snapshot_base or None)
+
     @provides(KStudyTeamLookup)
     @inject(rt=(rtconfig.Options, ldaplib.CONFIG_SECTION))
     def study_team_lookup(self, rt):
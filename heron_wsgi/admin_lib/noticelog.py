@@ -7,7 +7,14 @@ Sponsorship Records
 *******************
 
   >>> dr.sponsorships('some.one')
-  [(u'6373469799195807417', u'1', u'1', u'some.one', u'john.smith', u'')]
+  [(u'6373469799195807417', u'1', u'1', u'some.one', u'john.smith', None)]
+
+Expiration dates are typed as such:
+
+  >>> dr.sponsorships('jill.student')
+  ... # doctest: +NORMALIZE_WHITESPACE
+  [(u'93180811818667777', u'1', u'1', u'jill.student', u'prof.fickle',
+    datetime.date(2050, 2, 27))]
 
 Expired sponsorships are filtered out:
 
@@ -17,7 +24,7 @@ Expired sponsorships are filtered out:
 Projects sponsored by an investigator:
 
   >>> dr.sponsorships('john.smith', inv=True)
-  [(u'6373469799195807417', u'1', u'1', u'john.smith', u'john.smith', u'')]
+  [(u'6373469799195807417', u'1', u'1', u'john.smith', u'john.smith', None)]
 
 Sponsorship details:
   >>> dr.about_sponsorships('some.one')  # doctest: +NORMALIZE_WHITESPACE
@@ -114,15 +121,18 @@ The following table is used to log notices::
 
 from pprint import pformat
 import logging
+import threading
+import time
 from collections import namedtuple
 
 import injector
-from injector import inject, provides
-from sqlalchemy import Table, Column
-from sqlalchemy.types import Integer, VARCHAR, TIMESTAMP
+from injector import inject, provides, singleton
+from sqlalchemy import Table, Column, Index
+from sqlalchemy.types import Date, Integer, VARCHAR, TIMESTAMP
 from sqlalchemy.schema import ForeignKey
 from sqlalchemy import orm
-from sqlalchemy.sql import select, func, and_, or_
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.sql import select, func, and_, or_, literal
 import pkg_resources as pkg
 
 import rtconfig
@@ -144,6 +154,277 @@ notice_log = Table('notice_log', redcapdb.Base.metadata,
                    mysql_engine='InnoDB',
                    mysql_collate='utf8_unicode_ci')
 
+# Materialized from _sponsor_queries; see SponsorshipTable.
+# inv=1 rows have the investigator (sponsor) as candidate.
+sponsorship = Table('sponsorship', redcapdb.Base.metadata,
+                    Column('record', VARCHAR(100), primary_key=True),
+                    Column('inv', Integer, primary_key=True),
+                    Column('candidate', VARCHAR(100), primary_key=True),
+                    Column('sponsor', VARCHAR(100)),
+                    Column('decision', VARCHAR(10)),
+                    Column('what_for', VARCHAR(10)),
+                    Column('expires', Date),
+                    Index('sponsorship_candidate_sponsor',
+                          'candidate', 'sponsor'),
+                    mysql_engine='InnoDB',
+                    mysql_collate='utf8_unicode_ci')
+oversight_decision = Table('oversight_decision', redcapdb.Base.metadata,
+                           Column('record', VARCHAR(100), primary_key=True),
+                           Column('decision', VARCHAR(10)),
+                           mysql_engine='InnoDB',
+                           mysql_collate='utf8_unicode_ci')
+# Latest redcap_log_event reflected in the tables above, so that
+# a process can pick up where others left off.
+sponsorship_mark = Table('sponsorship_mark', redcapdb.Base.metadata,
+                         Column('project_id', Integer, primary_key=True),
+                         Column('log_event_id', Integer),
+                         mysql_engine='InnoDB')
+
+
+class SponsorshipTable(object):
+    '''Keep oversight decisions and sponsorships in indexed tables,
+    rather than re-deriving them from the REDCap EAV data on each use.
+
+    >>> (st, ) = Mock.make([SponsorshipTable])
+    >>> s = st._smaker()
+    >>> s.execute(sponsorship.select().where(
+    ...     sponsorship.c.candidate == 'some.one')).fetchall()
+    [(u'6373469799195807417', 0, u'some.one', u'john.smith', u'1', u'1', None)]
+
+    Later refreshes find records changed since the last one
+    in the REDCap log, and re-derive only those::
+
+    >>> for k, v in [('user_id', 'john.smith'), ('user_id_1', 'jill.student'),
+    ...              ('what_for', '1'),
+    ...              ('approve_kuh', '1'), ('approve_kumc', '1')]:
+    ...     _ = s.execute(redcapdb.redcap_data.insert().values(
+    ...         project_id=34, event_id=1, record='r123',
+    ...         field_name=k, value=v))
+    >>> def log_event(pk, event='UPDATE', object_type='redcap_data',
+    ...               **kw):
+    ...     _ = s.execute(redcapdb.redcap_log_event.insert().values(
+    ...         project_id=34, ts=20110902000000, pk=pk,
+    ...         object_type=object_type, event=event, **kw))
+    ...     s.commit()
+    >>> log_event('r123')
+    >>> st.run_once()
+    [u'r123']
+    >>> s.execute(sponsorship.select().where(
+    ...     sponsorship.c.record == 'r123')).fetchall()
+    ... # doctest: +NORMALIZE_WHITESPACE
+    [(u'r123', 0, u'jill.student', u'john.smith', u'1', u'1', None),
+     (u'r123', 1, u'john.smith', u'john.smith', u'1', u'1', None)]
+    >>> st.run_once()
+    []
+
+Log events other than data changes are ignored::
+
+    >>> log_event('r123', event='DATA_EXPORT', object_type='redcap_data')
+    >>> log_event('r123', event='MANAGE', object_type='redcap_projects')
+    >>> st.run_once()
+    []
+
+A transaction that got its log_event_id early may commit after
+later ones have been seen, so the last `overlap` ids are checked again::
+
+    >>> le = redcapdb.redcap_log_event
+    >>> top = s.execute(select([func.max(le.c.log_event_id)])).scalar()
+    >>> log_event('r2', log_event_id=top + 10)
+    >>> st.run_once()
+    [u'r2']
+    >>> log_event('r1', log_event_id=top + 5)
+    >>> st.run_once()
+    [u'r1']
+
+The tables record where they're up to, so that another process
+(e.g. another web server worker) can start from there, checking
+just the last `overlap` ids, rather than rebuilding them all::
+
+    >>> st2 = SponsorshipTable(34, DecisionRecords.institutions, st._smaker)
+    >>> st2.run_once()
+    [u'r1', u'r123', u'r2']
+
+Changes that don't show up in the log, such as direct database
+writes, are reconciled by a full rebuild every `full_every` seconds::
+
+    >>> now = [0]
+    >>> st3 = SponsorshipTable(34, DecisionRecords.institutions, st._smaker,
+    ...                        full_every=3600, clock=lambda: now[0])
+    >>> st3.run_once()
+    [u'r1', u'r123', u'r2']
+    >>> _ = s.execute(redcapdb.redcap_data.update().where(and_(
+    ...     redcapdb.redcap_data.c.record == 'r123',
+    ...     redcapdb.redcap_data.c.field_name == 'approve_kuh')).values(
+    ...         value='2'))
+    >>> s.commit()
+    >>> st3.run_once()
+    []
+    >>> now[0] += 3600
+    >>> st3.run_once() is None
+    True
+    >>> s.execute(sponsorship.select().where(
+    ...     sponsorship.c.record == 'r123')).fetchall()
+    []
+
+    Until :meth:`start` is called to refresh in the background,
+    :meth:`catch_up` refreshes on demand.
+
+    :param interval: seconds between refreshes in the background
+    :param overlap: how many log_event_ids before the latest seen
+                    to check again
+    :param full_every: rebuild all records every this many seconds
+    '''
+    # redcap_log_event.event values for changes to redcap_data
+    data_events = ('INSERT', 'UPDATE', 'DELETE')
+
+    def __init__(self, project_id, parties, smaker, schema=None,
+                 interval=60, overlap=1000, full_every=3600,
+                 clock=time.time):
+        self.project_id = project_id
+        self.parties = parties
+        self._smaker = smaker
+        self.interval = interval
+        self.overlap = overlap
+        self.full_every = full_every
+        self.__clock = clock
+        # ISSUE: tables are global mutable state, as with notice_log
+        sponsorship.schema = oversight_decision.schema = schema
+        sponsorship_mark.schema = schema
+        self.__since = None
+        self.__seen = frozenset()  # log_event_ids within overlap of since
+        self.__rebuilt = None  # clock() as of the last full rebuild
+        self.__stop = threading.Event()
+        self.__started = False
+        self.__lock = threading.Lock()
+
+    def create(self, bind):
+        for t in [sponsorship, oversight_decision, sponsorship_mark]:
+            t.create(bind, checkfirst=True)
+
+    def refresh(self, s, records=None):
+        '''Re-derive rows for records (or all records, if None).
+        '''
+        decision, _c, _w = _sponsor_queries(self.project_id, self.parties)
+        for t in [sponsorship, oversight_decision]:
+            s.execute(t.delete() if records is None else
+                      t.delete().where(t.c.record.in_(records)))
+
+        def which(q, record):
+            return q if records is None else q.where(record.in_(records))
+
+        s.execute(oversight_decision.insert().from_select(
+            ['record', 'decision'],
+            which(select([decision.c.record, decision.c.decision]),
+                  decision.c.record)))
+        for inv in [0, 1]:
+            _d, _c, cdwho = _sponsor_queries(self.project_id, self.parties,
+                                             inv=bool(inv))
+            mw = cdwho.alias('mw')
+            s.execute(sponsorship.insert().from_select(
+                ['record', 'inv', 'candidate', 'sponsor',
+                 'decision', 'what_for', 'expires'],
+                which(select([mw.c.record, literal(inv), mw.c.candidate,
+                              mw.c.sponsor, mw.c.decision, mw.c.what_for,
+                              # REDCap dates are yyyy-mm-dd text
+                              func.nullif(mw.c.dt_exp, '')]).distinct(),
+                      mw.c.record)))
+
+    def run_once(self):
+        '''Refresh records logged as changed since the last run.
+
+        The first run picks up from the mark left by earlier runs,
+        perhaps in other processes, or, failing that, refreshes
+        all records. All records are also refreshed once
+        `full_every` seconds have passed since that.
+
+        :return: changed records, or None for all
+        '''
+        with self.__lock:
+            s = self._smaker()
+            try:
+                now = self.__clock()
+                if self.__since is None:
+                    self.__since = self._mark(s)
+                    self.__rebuilt = now
+                records = (self._rebuild(s, now)
+                           if (self.__since is None or
+                               now - self.__rebuilt >= self.full_every)
+                           else self._changes(s))
+            finally:
+                s.close()
+        log.debug('sponsorships refreshed: %s',
+                  'all' if records is None else len(records))
+        return records
+
+    def _mark(self, s):
+        m = sponsorship_mark
+        return s.execute(select([m.c.log_event_id]).where(
+            m.c.project_id == self.project_id)).scalar()
+
+    def _set_mark(self, s, log_event_id):
+        m = sponsorship_mark
+        if not s.execute(m.update().where(
+                m.c.project_id == self.project_id).values(
+                    log_event_id=log_event_id)).rowcount:
+            s.execute(m.insert().values(project_id=self.project_id,
+                                        log_event_id=log_event_id))
+
+    def _rebuild(self, s, now):
+        le = redcapdb.redcap_log_event
+        top = s.execute(select([func.max(le.c.log_event_id)]).where(
+            le.c.project_id == self.project_id)).scalar() or 0
+        self.refresh(s)
+        self._set_mark(s, top)
+        s.commit()
+        self.__since = top
+        self.__rebuilt = now
+        return None
+
+    def _changes(self, s):
+        le = redcapdb.redcap_log_event
+        rows = s.execute(select([le.c.log_event_id, le.c.pk]).where(and_(
+            le.c.project_id == self.project_id,
+            le.c.object_type == 'redcap_data',
+            le.c.event.in_(self.data_events),
+            le.c.log_event_id > self.__since - self.overlap))).fetchall()
+        records = sorted(set(row.pk for row in rows
+                             if row.log_event_id not in self.__seen))
+        top = max([self.__since] + [row.log_event_id for row in rows])
+        if records:
+            self.refresh(s, records)
+        if records or top > self.__since:
+            self._set_mark(s, top)
+            s.commit()
+        self.__since = top
+        self.__seen = frozenset(row.log_event_id for row in rows
+                                if row.log_event_id > top - self.overlap)
+        return records
+
+    def catch_up(self):
+        '''Refresh now, unless that's done in the background.
+        '''
+        if not self.__started:
+            self.run_once()
+
+    def start(self):
+        self.__started = True
+        t = threading.Thread(target=self._loop,
+                             name='noticelog.SponsorshipTable')
+        t.daemon = True
+        t.start()
+        return t
+
+    def stop(self):
+        self.__stop.set()
+
+    def _loop(self):
+        while not self.__stop.is_set():
+            try:
+                self.run_once()
+            except Exception:
+                log.warn('refreshing sponsorships failed', exc_info=True)
+            self.__stop.wait(self.interval)
+
 
 class DecisionRecords(Token):
     '''
@@ -173,54 +454,66 @@ class DecisionRecords(Token):
             smaker=(orm.session.Session, redcapdb.CONFIG_SECTION),
             browser=medcenter.Browser,
             notice_log_schema=KNoticeLogSchema,
-            clock=rtconfig.Clock)
-    def __init__(self, pid, smaker, browser, notice_log_schema, clock):
+            clock=rtconfig.Clock,
+            _sponsorship_table=SponsorshipTable)
+    def __init__(self, pid, smaker, browser, notice_log_schema, clock,
+                 _sponsorship_table):
         self._oversight_project_id = pid
         self._browser = browser
         self._smaker = smaker
         self._clock = clock
         self._notice_log_schema = notice_log_schema
+        self._sponsorship_table = _sponsorship_table
+
+    def sponsorships(self, uid, inv=False, limit=None, offset=None):
+        '''Enumerate current (un-expired) sponsorships by/for uid,
+        those that expire last (or never) first.
 
-    def sponsorships(self, uid, inv=False):
-        '''Enumerate current (un-expired) sponsorships by/for uid.
         :param inv: True=by (i.e. investigator); False=for
+        :param limit: at most this many
+        :param offset: skip this many, as for the next page
         '''
-        _d, _c, dc = _sponsor_queries(self._oversight_project_id,
-                                      self.institutions, inv)
-
-        # mysql work-around for
-        # 1248, 'Every derived table must have its own alias'
-        dc = dc.alias('mw')
-        q = dc.select(and_(dc.c.candidate == uid,
-                           dc.c.decision == DecisionRecords.YES,
-                           dc.c.what_for == DecisionRecords.SPONSORSHIP)).\
-                               order_by(dc.c.record)
-
-        answers = self._smaker().execute(q).fetchall()
-        min_exp = self._clock.now()
-        return [ans for ans in answers
-                # hmm... why not do this date comparison in the database?
-                if (ans.dt_exp <= ''
-                    or min_exp.isoformat() <= ans.dt_exp)]
+        self._sponsorship_table.catch_up()
+        sp = sponsorship
+        today = self._clock.now().date()
+        q = select([sp.c.record, sp.c.decision, sp.c.what_for,
+                    sp.c.candidate, sp.c.sponsor,
+                    sp.c.expires.label('dt_exp')]).where(
+                        and_(sp.c.candidate == uid,
+                             sp.c.inv == (1 if inv else 0),
+                             sp.c.decision == DecisionRecords.YES,
+                             sp.c.what_for == DecisionRecords.SPONSORSHIP,
+                             # sponsorship ends as its expiration date begins
+                             or_(sp.c.expires == None,  # noqa
+                                 sp.c.expires > today))).\
+            order_by((sp.c.expires == None).desc(),  # noqa
+                     sp.c.expires.desc(), sp.c.record).\
+            limit(limit).offset(offset)
+
+        return self._smaker().execute(q).fetchall()
 
     def about_sponsorships(self, who, inv=False):
         '''
         :param String who: user_id of sponsoree (or, if inv_role, sponsor)
         :param Boolean inv: look up sponsorships where who is the sponsor
         '''
+        records = [sponsorship.record
+                   for sponsorship in self.sponsorships(who, inv)]
+        details = self.decision_details(records)
         return [(record, inv_ref, detail.get('project_title', ''),
                  project_description(detail))
                 for record, (inv_ref, team, detail) in [
-                        (sponsorship.record,
-                         self.decision_detail(sponsorship.record))
-                        for sponsorship in self.sponsorships(who, inv)]]
+                        (record, details[record])
+                        for record in records if record in details]]
 
     def oversight_decisions(self, pending=True):
         '''In order to facilitate email notification of committee
         decisions, find decisions where notification has not been sent.
         '''
-        cd, who, cdwho = _sponsor_queries(self._oversight_project_id,
-                                          self.institutions)
+        self._sponsorship_table.catch_up()
+        od = oversight_decision
+        cd = select([od.c.record, od.c.decision,
+                     literal(len(self.institutions))]).order_by(od.c.record)
 
         # decisions without notifications
         if pending:
@@ -228,9 +521,9 @@ class DecisionRecords(Token):
             nl = notice_log
             nl.schema = self._notice_log_schema
             # pyflakes doesn't like the == None SQLAlchemy idiom
-            dwn = cd.outerjoin(nl).select() \
-                                  .with_only_columns(cd.columns)\
-                                  .where(nl.c.record == None)  # noqa
+            dwn = cd.select_from(
+                od.outerjoin(nl, nl.c.record == od.c.record))\
+                    .where(nl.c.record == None)  # noqa
         else:
             dwn = cd
 
@@ -242,20 +535,36 @@ class DecisionRecords(Token):
                                     self._oversight_project_id,
                                     record))
         s.close()
-
-        def ref(user_id_n):
-            cn = d[user_id_n]
-            name_etc_n = user_id_n.replace('user_id_', 'name_etc_')
-            name_etc = d.get(name_etc_n, '')
-            fn = name_etc.split('\n')[0]
-            return Ref(cn, fn, name_etc)
-
-        inv = Ref(d['user_id'], d['full_name'], None)
-        team = [ref(user_id_n)
-                for user_id_n in sorted(d.keys())
-                if user_id_n.startswith('user_id_')]
-
-        return inv, team, d
+        return _detail_refs(d)
+
+    def decision_details(self, records):
+        '''Get details of several decisions in one query.
+
+        :return: a dict from record to (inv, team, detail),
+                 as from :meth:`decision_detail`; records that
+                 are missing or lack an investigator are left out.
+
+        >>> (dr, ) = Mock.make([DecisionRecords])
+        >>> records = [r for (r, _, _) in dr.oversight_decisions()]
+        >>> details = dr.decision_details(records + [u'-1'])
+        >>> sorted(set(records) - set(details))
+        [u'3180811818667777']
+        >>> details[records[-1]] == dr.decision_detail(records[-1])
+        True
+        '''
+        s = self._smaker()
+        details = {}
+        try:
+            for record, fields in redcapdb.allfields_many(
+                    s, self._oversight_project_id, records):
+                try:
+                    details[record] = _detail_refs(dict(fields))
+                except KeyError as oops:
+                    log.warn('decision_details: bad record? %s: %s',
+                             record, oops)
+        finally:
+            s.close()
+        return details
 
     def team_email(self, inv_uid, team_uids):
         '''Get email addresses for investigator plus those team members
@@ -270,9 +579,22 @@ class DecisionRecords(Token):
                 log.warn('cannot get email for %s', who, exc_info=ex)
                 return None
 
-        return (browser.lookup(inv_uid).mail,
+        inv = browser.lookup(inv_uid)
+        try:
+            team = browser.lookup_many(team_uids, strict=False)
+        except Exception as ex:
+            # e.g. an ambiguous cn or an LDAP error; find out whose
+            log.warn('cannot look up team of %s at once', inv_uid,
+                     exc_info=ex)
+            team = [try_lookup(uid) for uid in team_uids]
+        else:
+            for uid, entry in zip(team_uids, team):
+                if entry is None:
+                    log.warn('cannot get email for %s', uid)
+
+        return (inv.mail,
                 [entry.mail
-                 for entry in [try_lookup(uid) for uid in team_uids]
+                 for entry in team
                  if entry and hasattr(entry, 'mail') and entry.mail])
 
 
@@ -292,10 +614,34 @@ class Ref(ProperName):
         return self.fn
 
 
+def _detail_refs(d):
+    '''Find investigator and team in the fields of a decision.
+
+    >>> _detail_refs({'user_id': 'john.smith', 'full_name': 'John Smith',
+    ...               'user_id_2': 'bill.student',
+    ...               'user_id_1': 'some.one', 'name_etc_1': 'Some One\\netc.'
+    ...               })[:2]
+    (John Smith <john.smith>, [Some One <some.one>, ? <bill.student>])
+    '''
+    def ref(user_id_n):
+        cn = d[user_id_n]
+        name_etc_n = user_id_n.replace('user_id_', 'name_etc_')
+        name_etc = d.get(name_etc_n, '')
+        fn = name_etc.split('\n')[0]
+        return Ref(cn, fn, name_etc)
+
+    inv = Ref(d['user_id'], d['full_name'], None)
+    team = [ref(user_id_n)
+            for user_id_n in sorted(d.keys())
+            if user_id_n.startswith('user_id_')]
+
+    return inv, team, d
+
+
 def _sponsor_queries(oversight_project_id, parties, inv=False):
     '''
-    TODO: consider a separate table of approved users, generated when
-    notices are sent. include expirations (and link back to request).
+    These derive :data:`sponsorship` and :data:`oversight_decision`;
+    see :class:`SponsorshipTable`.
 
       >>> from pprint import pprint
       >>> decision, candidate, cdwho = _sponsor_queries(123, ['kuh', 'kumc'])
@@ -509,6 +855,18 @@ class Mock(injector.Module, rtconfig.MockMixin):
     def notice_log_schema(self):
         return None
 
+    @singleton
+    @provides(SponsorshipTable)
+    @inject(pid=KProjectId,
+            smaker=(orm.session.Session, redcapdb.CONFIG_SECTION))
+    def sponsorship_table(self, pid, smaker):
+        st = SponsorshipTable(pid, DecisionRecords.institutions, smaker)
+        s = smaker()
+        st.create(s.bind)
+        redcapdb.redcap_log_event.create(s.bind, checkfirst=True)
+        st.run_once()
+        return st
+
     @classmethod
     def mods(cls):
         return redcapdb.Mock.mods() + medcenter.Mock.mods() + [cls()]
@@ -524,6 +882,36 @@ class RunTime(rtconfig.IniModule):  # pragma nocover
     def notice_log_schema(self):
         return 'droctools'
 
+    @singleton
+    @provides(SponsorshipTable)
+    @inject(pid=KProjectId,
+            smaker=(orm.session.Session, redcapdb.CONFIG_SECTION),
+            schema=KNoticeLogSchema)
+    def sponsorship_table(self, pid, smaker, schema):
+        '''Refresh every `sponsorship_refresh` seconds (default: 60),
+        rebuilding fully every `sponsorship_rebuild` seconds
+        (default: 3600).
+
+        The tables are created if need be.
+        '''
+        rt = self.get_options(['sponsorship_refresh', 'sponsorship_rebuild'],
+                              OVERSIGHT_CONFIG_SECTION)
+        st = SponsorshipTable(pid, DecisionRecords.institutions, smaker,
+                              schema=schema,
+                              interval=int(rt.sponsorship_refresh or 60),
+                              full_every=int(rt.sponsorship_rebuild or 3600))
+        s = smaker()
+        try:
+            st.create(s.bind)
+        except SQLAlchemyError:
+            log.error('cannot create sponsorship tables;'
+                      ' run noticelog.py --create-tables'
+                      ' with a database account that can.')
+            raise
+        finally:
+            s.close()
+        return st
+
     @classmethod
     def mods(cls, ini, **kwargs):
         return (
@@ -549,13 +937,16 @@ if __name__ == '__main__':  # pragma nocover
 
         logging.basicConfig(level=logging.INFO)
 
-        [ds] = RunTime.make(
-            [DecisionRecords],
+        [ds, st] = RunTime.make(
+            [DecisionRecords, SponsorshipTable],
             ini=ini, timesrc=datetime,
             create_engine=create_engine,
             urlopener=lose, ldap=lose, trainingfn=lose)
 
-        if '--migrate' in argv:
+        if '--create-tables' in argv:
+            st.create(st._smaker().bind)
+            raise SystemExit(0)
+        elif '--migrate' in argv:
             migrate_decisions(ds, stdout)
             raise SystemExit(0)
         elif '--sponsorships' in argv:
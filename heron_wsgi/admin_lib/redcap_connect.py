@@ -48,12 +48,14 @@ from pprint import pformat
 from urllib import urlencode
 from urlparse import urljoin, urlparse, parse_qs
 
-from injector import singleton, provides, Key
+from injector import inject, singleton, provides, Key
 from sqlalchemy.engine.base import Connectable
 
 from ocap_file import Path
+import breaker
 import rtconfig
 import redcap_invite
+import redcapdb
 
 log = logging.getLogger(__name__)
 
@@ -83,6 +85,14 @@ class SurveySetup(object):
     def responses(self, email):
         return self.__ss.responses(email)
 
+    def responses_many(self, emails):
+        return self.__ss.responses_many(emails)
+
+    def forget_event(self):
+        '''Look up the survey's event again next time it's needed.
+        '''
+        self.__ss.forget_event()
+
     @classmethod
     def _surveycode(cls, url):
         """Get survey code from survey URL
@@ -113,9 +123,12 @@ class RunTime(rtconfig.IniModule):  # pragma: nocover
 
     @singleton
     @provides((Connectable, redcap_invite.CONFIG_SECTION))
-    def db_engine(self):
+    @inject(breakers=breaker.Breakers)
+    def db_engine(self, breakers):
         opts = self.get_options(['engine'], redcap_invite.CONFIG_SECTION)
-        return self.__create_engine(opts.engine, pool_recycle=3600)
+        return breaker.guard(
+            self.__create_engine(opts.engine, pool_recycle=3600),
+            breakers.breaker(redcapdb.BREAKER))
 
     @singleton
     @provides(KRandom)
@@ -130,7 +143,7 @@ class RunTime(rtconfig.IniModule):  # pragma: nocover
         return SurveySetup(opts, connect, rng, survey_id=survey_id)
 
     def _integration_test(self, userid, fullName, stderr):
-        connect = self.db_engine().connect
+        connect = self.db_engine(breaker.Breakers()).connect
         rng = self.__rng
         ea_opts = [
             self.get_options(OPTIONS, section)
@@ -28,34 +28,91 @@ He hasn't responded yet:
     >>> saa.responses('bob@js.example')
     []
 
+We can check several addresses with one query:
+
+    >>> found = saa.responses_many(['big.wig@js.example', 'bob@js.example'])
+    >>> [(r.record, r.completion_time)
+    ...  for r in found['big.wig@js.example']]
+    [(u'3253004250825796194', datetime.datetime(2011, 8, 26, 0, 0))]
+    >>> found['bob@js.example']
+    []
+
 '''
 
 from __future__ import print_function
 from ConfigParser import SafeConfigParser
+from collections import namedtuple
 from random import Random as Random_T
 import datetime
 import logging
-from typing import Callable, List, Optional as Opt, TextIO, Tuple
+import threading
+import time
+from typing import (Any, Callable, Dict, List, Optional as Opt, TextIO,
+                    Tuple)
 
 from sqlalchemy import and_, select
 from sqlalchemy.engine import Connection  # type only
 from sqlalchemy.exc import OperationalError
 from sqlalchemy.sql.expression import Executable
 
+import breaker
 import redcapdb
 
 log = logging.getLogger(__name__)
 CONFIG_SECTION = 'survey_invite'
 
 Nonce = str
+Response = namedtuple('Response', ['record', 'completion_time'])
 
 
 class SecureSurvey(object):
-    def __init__(self, connect, rng, survey_id):
-        # type: (Callable[..., Connection], Random_T, int) -> None
+    def __init__(self, connect, rng, survey_id,
+                 event_ttl=24 * 60 * 60, clock=time.time, sleep=time.sleep):
+        # type: (Callable[..., Connection], Random_T, int, float, Callable[[], float], Callable[[float], None]) -> None  # noqa
         self.__connect = connect
         self.__rng = rng
         self.survey_id = survey_id
+        self.event_ttl = event_ttl
+        self.__clock = clock
+        self.__sleep = sleep
+        self.__event = None  # type: Opt[Tuple[float, int]]
+        self.__lock = threading.Lock()
+
+    def event_id(self, conn):
+        # type: (Connection) -> int
+        '''Find the event for this survey; remember it for `event_ttl` sec.
+
+        >>> io = MockIO()
+        >>> from sqlalchemy import event
+        >>> executed = []
+        >>> event.listen(io.connect.__self__, 'before_cursor_execute',
+        ...              lambda conn, cur, stmt, *etc: executed.append(stmt))
+        >>> saa = SecureSurvey(io.connect, io.rng, 11)
+        >>> conn = io.connect()
+        >>> saa.event_id(conn), saa.event_id(conn), len(executed)
+        (1, 1, 1)
+
+        An event can be forgotten explicitly, as when a survey is
+        moved to another arm:
+
+        >>> saa.forget_event()
+        >>> saa.event_id(conn), len(executed)
+        (1, 2)
+        '''
+        with self.__lock:
+            if self.__event:
+                expire, event_id = self.__event
+                if self.__clock() < expire:
+                    return event_id
+        event_id = conn.execute(self._event_q(self.survey_id)).scalar()
+        with self.__lock:
+            self.__event = (self.__clock() + self.event_ttl, event_id)
+        return event_id
+
+    def forget_event(self):
+        # type: () -> None
+        with self.__lock:
+            self.__event = None
 
     @classmethod
     def _config(cls, config_fp, config_filename, survey_section,
@@ -75,7 +132,7 @@ class SecureSurvey(object):
         :return: hash for participant
         '''
         conn = self.__connect()
-        event_id = conn.execute(self._event_q(self.survey_id)).scalar()
+        event_id = self.event_id(conn)
         pt, find = self._invitation_q(self.survey_id, event_id, multi)
 
         found = conn.execute(
@@ -227,43 +284,136 @@ class SecureSurvey(object):
 
         To work around persistent problems connecting to a
         REDCap DB for the system access survey, this method
-        tries `max_retries` to connect and then returns a
+        tries `max_retries` to connect, backing off exponentially
+        between tries, and then returns a
         known survey record rather than failing:
 
         >>> from random import Random
         >>> predictable = Random(1)
         >>> def lose(*argv):
         ...     raise OperationalError('select...', {}, None)
-        >>> ss = SecureSurvey(connect=lose, rng=predictable, survey_id=93)
+        >>> slept = []
+        >>> ss = SecureSurvey(connect=lose, rng=predictable, survey_id=93,
+        ...                   sleep=slept.append)
+        >>> ss.responses('daffy@walt.disney')
+        ['767', datetime.datetime(2017, 1, 25, 8, 55, 10)]
+        >>> len(slept), max(slept) <= 2
+        (9, True)
+
+        While the REDCap DB circuit breaker is open, we don't
+        wait around:
+
+        >>> def open_circuit(*argv):
+        ...     raise breaker.CircuitOpen('redcap: circuit open')
+        >>> slept = []
+        >>> ss = SecureSurvey(connect=open_circuit, rng=predictable,
+        ...                   survey_id=93, sleep=slept.append)
         >>> ss.responses('daffy@walt.disney')
         ['767', datetime.datetime(2017, 1, 25, 8, 55, 10)]
+        >>> slept
+        []
 
         '''
         # type: (str) -> List[Tuple(str, datetime)]
+        conn = self._connect_retrying(max_retries)
+        if conn is not None:
+            event_id = self.event_id(conn)
+            q = self._response_q(email, self.survey_id, event_id)
+            timestamp = conn.execute(q).fetchall()
+            return timestamp
+
+        log.warn('Connect failed! Making up data for {0}'.format(email))
+        eventResponse = (known_record_id, known_sig_time)
+
+        # placing tuple in list, to follow the original comment
+        # (line 2 of this method)
+        return list(eventResponse)
+
+    def responses_many(self, emails,
+                       max_retries=10,
+                       known_record_id='767',
+                       known_sig_time=datetime.datetime(2017, 1, 25,
+                                                        8, 55, 10)):
+        '''Find responses to this survey for each of several emails,
+        using one query.
+
+        As with :meth:`responses`, if we cannot connect, we make up
+        a known survey record:
+
+        >>> from random import Random
+        >>> def lose(*argv):
+        ...     raise OperationalError('select...', {}, None)
+        >>> ss = SecureSurvey(connect=lose, rng=Random(1), survey_id=93,
+        ...                   sleep=lambda sec: None)
+        >>> ss.responses_many(['daffy@walt.disney'])
+        ... # doctest: +NORMALIZE_WHITESPACE
+        {'daffy@walt.disney':
+         [Response(record='767',
+                   completion_time=datetime.datetime(2017, 1, 25, 8, 55, 10))]}
+
+        :return: a dict from each email to its list of rows with
+                 record, completion_time
+        '''
+        # type: (List[str]) -> Dict[str, List[Tuple(str, datetime)]]
+        conn = self._connect_retrying(max_retries)
+        if conn is None:
+            log.warn('Connect failed! Making up data for %s', emails)
+            return dict((email, [Response(known_record_id, known_sig_time)])
+                        for email in emails)
+
+        event_id = self.event_id(conn)
+        q = self._response_many_q(emails, self.survey_id, event_id)
+        return self._by_email(emails, conn.execute(q).fetchall())
+
+    @classmethod
+    def _by_email(cls, emails, rows):
+        # type: (List[str], List[Any]) -> Dict[str, List[Any]]
+        '''Group rows by the email each answers.
+
+        MySQL compares emails without regard to case or trailing
+        spaces, so a row may not spell its email as we did:
+
+        >>> Row = namedtuple('Row', ['participant_email', 'record'])
+        >>> found = SecureSurvey._by_email(
+        ...     ['Big.Wig@js.example', 'bob@js.example'],
+        ...     [Row('big.wig@JS.example', '1'), Row('bob@js.example ', '2'),
+        ...      Row('somebody.else@js.example', '3')])
+        >>> sorted(found.items())
+        ... # doctest: +NORMALIZE_WHITESPACE
+        [('Big.Wig@js.example',
+          [Row(participant_email='big.wig@JS.example', record='1')]),
+         ('bob@js.example',
+          [Row(participant_email='bob@js.example ', record='2')])]
+        '''
+        found = dict((email, []) for email in emails)
+        asked = {}  # type: Dict[str, List[str]]
+        for email in emails:
+            asked.setdefault(_norm_email(email), []).append(email)
+        for row in rows:
+            for email in asked.get(_norm_email(row.participant_email), []):
+                found[email].append(row)
+        return found
+
+    def _connect_retrying(self, max_retries, max_backoff=2):
+        # type: (int, float) -> Opt[Connection]
         retryCount = max_retries
 
         while retryCount > 0:
             try:
                 # Attempt Connection To REDCap DB
-                conn = self.__connect()
+                return self.__connect()
+            except breaker.CircuitOpen as oops:
+                log.info('%s', oops)
+                return None
             except OperationalError:
                 log.info(
                     'MySQL Connection Failed, trying {0} more times...'.format(
                         max_retries - retryCount))
                 retryCount = retryCount - 1
-            else:
-                event_id = conn.execute(self._event_q(self.survey_id)).scalar()
-                q = self._response_q(email, self.survey_id, event_id)
-                timestamp = conn.execute(q).fetchall()
-                return timestamp
-
-        if retryCount == 0:
-            log.warn('Connect failed! Making up data for {0}'.format(email))
-            eventResponse = (known_record_id, known_sig_time)
-
-        # placing tuple in list, to follow the original comment
-        # (line 2 of this method)
-        return list(eventResponse)
+                if retryCount > 0:
+                    self.__sleep(breaker.backoff(max_retries - retryCount - 1,
+                                                 cap=max_backoff))
+        return None
 
     @classmethod
     def _response_q(cls, email, survey_id, event_id):
@@ -287,6 +437,35 @@ class SecureSurvey(object):
                  p.c.survey_id == survey_id,
                  p.c.event_id == event_id))
 
+    @classmethod
+    def _response_many_q(cls, emails, survey_id, event_id):
+        # type: (List[str], int, int) -> Executable
+        '''
+        >>> q = SecureSurvey._response_many_q(['xyz@abc', 'x@y'], 12, 7)
+        >>> print(q)
+        ... # doctest: +NORMALIZE_WHITESPACE
+        SELECT p.participant_email, r.record, r.completion_time
+        FROM redcap_surveys_participants AS p, redcap_surveys_response AS r
+        WHERE r.participant_id = p.participant_id
+          AND p.participant_email IN (:participant_email_1,
+                                      :participant_email_2)
+          AND p.survey_id = :survey_id_1
+          AND p.event_id = :event_id_1
+        '''
+        r = redcapdb.redcap_surveys_response.alias('r')
+        p = redcapdb.redcap_surveys_participants.alias('p')
+        return select([p.c.participant_email,
+                       r.c.record, r.c.completion_time]).where(
+            and_(r.c.participant_id == p.c.participant_id,
+                 p.c.participant_email.in_(emails),
+                 p.c.survey_id == survey_id,
+                 p.c.event_id == event_id))
+
+
+def _norm_email(email):
+    # type: (str) -> str
+    return email.strip().lower()
+
 
 class MockIO(object):
     def __init__(self):
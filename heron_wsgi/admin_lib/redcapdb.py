@@ -51,7 +51,9 @@ ISSUE: refactor w.r.t. traincheck.redcapview
 
 '''
 
+from itertools import groupby
 import logging
+from operator import itemgetter
 import pkg_resources as pkg
 
 import injector
@@ -59,12 +61,13 @@ from injector import inject, provides, singleton
 from sqlalchemy import Table, Column, text
 from sqlalchemy.engine.base import Connectable
 from sqlalchemy.engine.url import URL
-from sqlalchemy.types import INTEGER, VARCHAR, TEXT, DATETIME
+from sqlalchemy.types import BIGINT, INTEGER, VARCHAR, TEXT, DATETIME
 from sqlalchemy.orm import mapper
 from sqlalchemy.orm import session, sessionmaker
-from sqlalchemy.sql import and_, select
+from sqlalchemy.sql import and_, case, distinct, func, select
 from sqlalchemy.ext.declarative import declarative_base
 
+import breaker
 import rtconfig
 from ocap_file import Path
 from sqlite_mem import _test_engine
@@ -72,6 +75,8 @@ from sqlite_mem import _test_engine
 log = logging.getLogger(__name__)
 Base = declarative_base()
 CONFIG_SECTION = 'redcapdb'
+# REDCap engines share a circuit breaker; see breaker.Breakers
+BREAKER = 'redcap'
 
 redcap_data = Table('redcap_data', Base.metadata,
                     Column(u'project_id', INTEGER(),
@@ -133,6 +138,18 @@ redcap_user_rights = Table(
     Column('username', VARCHAR))
 
 
+# REDCap logs each change to a record here; pk is the record
+# and ts is yyyymmddhhmmss.
+redcap_log_event = Table(
+    'redcap_log_event', Base.metadata,
+    Column(u'log_event_id', INTEGER(), primary_key=True, nullable=False),
+    Column(u'project_id', INTEGER()),
+    Column(u'ts', BIGINT()),
+    Column(u'object_type', VARCHAR(length=128)),
+    Column(u'event', VARCHAR(length=32)),
+    Column(u'pk', TEXT()))
+
+
 def eachcol(t1, t2, cols):
     '''
       >>> pairs = eachcol(redcap_data, redcap_data,
@@ -160,34 +177,101 @@ def colsmatch(t1, t2, cols):
     return and_(*[(t1c == t2c) for t1c, t2c in eachcol(t1, t2, cols)])
 
 
+# Past this many fields, unpivot() scans redcap_data once
+# rather than joining it to itself once per field. The joins are
+# quick while each is an index lookup (see bench_pivot), but MySQL
+# takes longer to plan each added table and allows at most 61.
+PIVOT_JOIN_LIMIT = 20
+
+
 def unpivot(field_names,
             pfx='j_',
             record=False,
-            redcap_data=redcap_data):
+            redcap_data=redcap_data,
+            aggregate=None,
+            project_id=None):
     '''Self-join redcap_data to unpivot EAV to row-modelling.
+
+    :param aggregate: rather than join, group by record and pick
+                      out each field with `MAX(CASE ...)`; by default,
+                      aggregate when there are more than
+                      :data:`PIVOT_JOIN_LIMIT` fields.
+    :param project_id: include only this project's records
+
+    Either way, only records with all the fields are included::
+
+      >>> cs, fs, wc, rel = unpivot(['study_id', 'age', 'sex'],
+      ...                           record=True, aggregate=True,
+      ...                           project_id=123)
+      >>> print(rel)
+      ... # doctest: +NORMALIZE_WHITESPACE
+      SELECT j_eav.project_id, j_eav.record,
+             max(CASE WHEN (j_eav.field_name = :field_name_1)
+                      THEN j_eav.value END) AS study_id,
+             max(CASE WHEN (j_eav.field_name = :field_name_2)
+                      THEN j_eav.value END) AS age,
+             max(CASE WHEN (j_eav.field_name = :field_name_3)
+                      THEN j_eav.value END) AS sex
+      FROM redcap_data AS j_eav
+      WHERE j_eav.field_name IN (:field_name_4, :field_name_5, :field_name_6)
+        AND j_eav.project_id = :project_id_1
+      GROUP BY j_eav.project_id, j_eav.record
+      HAVING count(DISTINCT j_eav.field_name) = :count_1
+      >>> [c.name for c in cs]
+      ['project_id', 'record', 'study_id', 'age', 'sex']
+
+    Give `project_id` here rather than filtering the result: MySQL
+    (before 8.0.22) can't push a filter into the grouped subquery,
+    so it would aggregate every project's data.
+
+    .. note:: The forms differ for fields with more than one value
+              per record, such as checkboxes: the join gives a row
+              for each combination of values, while the aggregate
+              gives one row per record, with the greatest value.
     '''
     if not field_names:
         raise ValueError(field_names)
+    if aggregate is None:
+        aggregate = len(field_names) > PIVOT_JOIN_LIMIT
+    if aggregate:
+        return _unpivot_aggregate(field_names, pfx, record, redcap_data,
+                                  project_id)
 
     froms = [(n, redcap_data.alias(pfx + n)) for n in field_names]
     d0 = froms[0]  # 0th redcap_data table
-    project_id = d0[1].c.project_id
-    cols = [project_id] + ([d0[1].c.record] if record else []) + [
+    pid = d0[1].c.project_id
+    cols = [pid] + ([d0[1].c.record] if record else []) + [
         frm.c.value.label(n) for (n, frm) in froms]
 
     project = [clause for (n, frm) in froms
                for clause in
-               [frm.c.project_id == project_id,
+               [frm.c.project_id == pid,
                 frm.c.field_name == n]]
     join = [froms[ix][1].c.record == froms[ix + 1][1].c.record
             for ix in range(len(froms) - 1)]
+    which = [] if project_id is None else [pid == project_id]
 
-    w = and_(*project + join)
+    w = and_(*project + join + which)
     from_obj = [f for (n, f) in froms]
     relation = select(cols, w, from_obj=from_obj)
     return cols, from_obj, w, relation
 
 
+def _unpivot_aggregate(field_names, pfx, record, redcap_data, project_id):
+    eav = redcap_data.alias(pfx + 'eav')
+    cols = [eav.c.project_id] + ([eav.c.record] if record else []) + [
+        func.max(case([(eav.c.field_name == n, eav.c.value)])).label(n)
+        for n in field_names]
+    w = eav.c.field_name.in_(field_names)
+    if project_id is not None:
+        w = and_(w, eav.c.project_id == project_id)
+    from_obj = [eav]
+    relation = select(cols, w, from_obj=from_obj).group_by(
+        eav.c.project_id, eav.c.record).having(
+            func.count(distinct(eav.c.field_name)) == len(set(field_names)))
+    return cols, from_obj, w, relation
+
+
 class REDCapRecord(object):
     '''Abstract class that provides mapping of fields to redcap EAV structure.
 
@@ -292,6 +376,43 @@ def allfields(ex, project_id, record):
         yield k, v
 
 
+def allfields_many(ex, project_id, records):
+    '''Iterate over all fields of several REDCap records in one query.
+
+    :param records: to match redcap_data
+    :return: an iterator over (record, [(k, v), ...]) pairs,
+             in order of record; records with no fields are skipped.
+
+    For example::
+
+      >>> (smaker, ) = Mock.make([(session.Session,
+      ...                          CONFIG_SECTION)])
+      >>> s = smaker()
+      >>> for record, k, v in ((1, 'study_id', 'test_002'), (1, 'age', 32),
+      ...                      (3, 'study_id', 'test_003'), (3, 'sex', 'f')):
+      ...     s.execute(redcap_data.insert().values(event_id=321,
+      ...                                           project_id=1234,
+      ...                                           record=record,
+      ...                                           field_name=k,
+      ...                                           value=v)) and None
+
+      >>> for record, fields in allfields_many(s, 1234, [1, 2, 3]):
+      ...     print record, fields
+      1 [(u'age', u'32'), (u'study_id', u'test_002')]
+      3 [(u'sex', u'f'), (u'study_id', u'test_003')]
+    '''
+    records = list(records)
+    if not records:
+        return
+    c = redcap_data.c
+    rows = ex.execute(select((c.record, c.field_name, c.value))
+                      .where(and_(c.project_id == project_id,
+                                  c.record.in_(records)))
+                      .order_by(c.record))
+    for record, fields in groupby(rows, itemgetter(0)):
+        yield record, [(k, v) for (_, k, v) in fields]
+
+
 class SetUp(injector.Module):
     # abusing Session a bit; this really provides a subclass,
     # not an instance, of Session
@@ -364,8 +485,9 @@ class RunTime(rtconfig.IniModule):  # pragma: nocover
 
     @singleton
     @provides((Connectable, CONFIG_SECTION))
-    @inject(rt=(rtconfig.Options, CONFIG_SECTION))
-    def redcap_datasource(self, rt, driver='mysql+pymysql'):
+    @inject(rt=(rtconfig.Options, CONFIG_SECTION),
+            breakers=breaker.Breakers)
+    def redcap_datasource(self, rt, breakers, driver='mysql+pymysql'):
         # support sqlite3 driver?
         u = (rt.engine if rt.engine else
              URL(driver, rt.user, rt.password,
@@ -373,7 +495,8 @@ class RunTime(rtconfig.IniModule):  # pragma: nocover
 
         # http://www.sqlalchemy.org/docs/dialects/mysql.html
         #      #connection-timeouts
-        return self.__create_engine(u, pool_recycle=3600)
+        return breaker.guard(self.__create_engine(u, pool_recycle=3600),
+                             breakers.breaker(BREAKER))
 
     @classmethod
     def mods(cls, ini, create_engine, **kwargs):
@@ -19,6 +19,8 @@ import logging
 import injector
 from injector import provides, singleton
 
+from cache_remote import KSharedStore
+
 
 class Options(object):
     def __init__(self, attrs, d):
@@ -237,6 +239,36 @@ class IniModule(injector.Module, _Maker):  # pragma: nocover
         return [cls(ini, **kwargs)]
 
 
+class SharedCacheInjector(IniModule):  # pragma: nocover
+    '''Provide a cache store shared among processes, if configured::
+
+      [cache]
+      store=/var/cache/heron-admin/cache.db
+
+    The database file is created readable and writable only by the
+    account that runs the app; other processes that can write it
+    could feed answers to this one.
+    '''
+    CONFIG_SECTION = 'cache'
+
+    @singleton
+    @provides(KSharedStore)
+    def store(self):
+        import os
+        import sqlite3
+        from cache_remote import SQLiteStore
+
+        try:
+            path = self.get_options(['store'], self.CONFIG_SECTION).store
+        except ConfigParser.NoSectionError:
+            path = None
+        if not path:
+            return None
+        os.close(os.open(path, os.O_RDWR | os.O_CREAT, 0o600))
+        os.chmod(path, 0o600)
+        return SQLiteStore(lambda: sqlite3.connect(path, timeout=5))
+
+
 def _logged(x):
     from sys import stderr
     from pprint import pprint
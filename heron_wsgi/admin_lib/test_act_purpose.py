@@ -113,6 +113,10 @@ class TestActSponsorship(unittest.TestCase):
                 project_id=project_id, event_id=event_id, record=record_id,
                 field_name=field, value=value)
             session.execute(dml)
+        # REDCap logs each change
+        session.execute(redcapdb.redcap_log_event.insert().values(
+            project_id=project_id, ts=20110902000000 + int(record_id),
+            pk=record_id, object_type='redcap_data', event='UPDATE'))
 
     def _login(self, uid, perm):
         req = medcenter.MockRequest()
@@ -112,20 +112,20 @@ class DROCNotice(Token):
 
     def build_notices(self, req):
         dr = self._dr
-        for record, decision, _ in dr.oversight_decisions():
-            if decision not in self.FINAL_DECISIONS:
-                continue
-
+        decisions = [(record, decision)
+                     for record, decision, _ in dr.oversight_decisions()
+                     if decision in self.FINAL_DECISIONS]
+        details = dr.decision_details([record for record, _ in decisions])
+        for record, decision in decisions:
             action = ('approved' if decision == DecisionRecords.YES
                       else 'rejected')
 
-            try:
-                investigator, team, detail = dr.decision_detail(record)
-                log.info('Notify %s and team that request %s is %s',
-                         investigator, record, action)
-            except Exception as oops:
-                log.error('build_notices: bad record? %s: %s' % (record, oops))
+            if record not in details:
+                log.error('build_notices: bad record? %s' % record)
                 continue
+            investigator, team, detail = details[record]
+            log.info('Notify %s and team that request %s is %s',
+                     investigator, record, action)
 
             try:
                 log.debug('build_notices team: %s', team)
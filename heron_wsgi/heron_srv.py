@@ -27,6 +27,9 @@ import stats
 import perf_reports
 from admin_lib import medcenter
 from admin_lib import heron_policy
+from admin_lib import i2b2pm
+from admin_lib import dirsnapshot
+from admin_lib import noticelog
 from admin_lib import redcap_connect
 from admin_lib import rtconfig
 from admin_lib.rtconfig import Options, TestTimeOptions
@@ -442,7 +445,7 @@ class TeamBuilder(Token):
 
         # Since we're the only supposed to supply these names,
         # it seems OK to throw KeyError if we hit a bad one.
-        team = [browser.lookup(n) for n in uids]
+        team = browser.lookup_many(uids)
         team.sort(key=lambda(a): (a.sn, a.givenname))
 
         investigator = None
@@ -754,8 +757,9 @@ def app_factory(global_config, **settings):
     cwd = Path('.', open=io_open, joinpath=joinpath, listdir=listdir)
 
     log.debug('in app_factory')
-    [config] = RunTime.make(
-        [HeronAdminConfig],
+    [config, revoker, names, sponsorships] = RunTime.make(
+        [HeronAdminConfig, i2b2pm.AuthRevoker,
+         dirsnapshot.DirectorySnapshot, noticelog.SponsorshipTable],
         cwd=cwd,
         settings=settings,
         create_engine=create_engine,
@@ -773,6 +777,10 @@ def app_factory(global_config, **settings):
                     context=Exception,
                     permission=pyramid.security.NO_PERMISSION_REQUIRED)
 
+    revoker.start()
+    names.start()
+    sponsorships.start()
+
     return config.make_wsgi_app()
 
 
@@ -4,12 +4,24 @@ import itertools
 import logging
 import math
 
+from injector import inject
+
 from admin_lib import heron_policy
+from admin_lib.breaker import Breakers
+from admin_lib.cache_remote import CacheStats
+from admin_lib.dbpool import PoolStats
 
 log = logging.getLogger(__name__)
 
 
 class PerformanceReports(object):
+    @inject(cache_stats=CacheStats,
+            pool_stats=PoolStats,
+            breakers=Breakers)
+    def __init__(self, cache_stats, pool_stats, breakers):
+        self._cache_stats = cache_stats
+        self._pool_stats = pool_stats
+        self._breakers = breakers
 
     def configure(self, config, mount_point):
         '''Connect this view to the rest of the application
@@ -22,6 +34,22 @@ class PerformanceReports(object):
                         request_method='GET', renderer='performance.html',
                         permission=heron_policy.PERM_STATS_REPORTER)
 
+        config.add_route('cache_stats', mount_point + 'cache_stats')
+        config.add_view(self.show_cache_stats, route_name='cache_stats',
+                        request_method='GET', renderer='json',
+                        permission=heron_policy.PERM_STATS_REPORTER)
+
+        config.add_route('db_pools', mount_point + 'db_pools')
+        config.add_view(self.show_db_pools, route_name='db_pools',
+                        request_method='GET', renderer='json',
+                        permission=heron_policy.PERM_STATS_REPORTER)
+
+        config.add_route('circuit_breakers', mount_point + 'circuit_breakers')
+        config.add_view(self.show_circuit_breakers,
+                        route_name='circuit_breakers',
+                        request_method='GET', renderer='json',
+                        permission=heron_policy.PERM_STATS_REPORTER)
+
     def show_performance(self, context, req):
         order = dict(INCOMPLETE=1,
                      COMPLETED=2,
@@ -38,6 +66,33 @@ class PerformanceReports(object):
                     log=math.log,
                     cycle=itertools.cycle)
 
+    def show_cache_stats(self, context, req):
+        '''Hit ratios, latency, and size of caches of remote queries.
+
+        >>> perf = PerformanceReports(CacheStats(), PoolStats(), Breakers())
+        >>> perf.show_cache_stats(None, None)
+        {'queries': {}, 'caches': {}}
+        '''
+        return self._cache_stats.snapshot()
+
+    def show_db_pools(self, context, req):
+        '''Connection pool checkouts, by database.
+
+        >>> perf = PerformanceReports(CacheStats(), PoolStats(), Breakers())
+        >>> perf.show_db_pools(None, None)
+        {}
+        '''
+        return self._pool_stats.snapshot()
+
+    def show_circuit_breakers(self, context, req):
+        '''Circuit breaker states and counts, by service.
+
+        >>> perf = PerformanceReports(CacheStats(), PoolStats(), Breakers())
+        >>> perf.show_circuit_breakers(None, None)
+        {}
+        '''
+        return self._breakers.snapshot()
+
 
 def _json_val(x):
     '''
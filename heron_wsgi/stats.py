@@ -75,16 +75,11 @@ class Reports(object):
 
         query_volume = usage.query_volume()
 
-        def details(uid):
-            try:
-                a = browser.lookup(user_id)
-                return '%s, %s' % (a.title, a.ou)
-            except KeyError:
-                return ''
-
-        user_ids = set([row.user_id for row in query_volume])
-        roles = dict([(user_id, details(user_id))
-                      for user_id in user_ids])
+        user_ids = sorted(set([row.user_id for row in query_volume]))
+        roles = dict([(user_id, '%s, %s' % (a.title, a.ou) if a else '')
+                      for (user_id, a) in
+                      zip(user_ids,
+                          browser.lookup_many(user_ids, strict=False))])
 
         return dict(total_number_of_queries=usage.total_number_of_queries(),
                     query_volume=query_volume,
@@ -38,6 +38,9 @@ The `unpivot()` function helps::
 from sqlalchemy import MetaData, Table, Column
 from sqlalchemy import Integer, String
 from sqlalchemy import select, text, and_
+from sqlalchemy import case, distinct, func
+
+from admin_lib.redcapdb import PIVOT_JOIN_LIMIT
 
 
 redcap_meta = MetaData()
@@ -90,12 +93,42 @@ def in_schema(name,
 
 def unpivot(project_id, field_names,
             record=False,
-            redcap_data=redcap_data):
+            redcap_data=redcap_data,
+            aggregate=None):
     '''
     ISSUE: import from redcapdb?
+
+    With more than :data:`admin_lib.redcapdb.PIVOT_JOIN_LIMIT` fields
+    (or `aggregate=True`), group by record rather than join::
+
+    >>> print unpivot(4688, ['username', 'expired', 'course'],
+    ...               aggregate=True)
+    ... # doctest: +NORMALIZE_WHITESPACE
+    SELECT max(CASE WHEN (eav.field_name = :field_name_1)
+                    THEN eav.value END) AS username,
+           max(CASE WHEN (eav.field_name = :field_name_2)
+                    THEN eav.value END) AS expired,
+           max(CASE WHEN (eav.field_name = :field_name_3)
+                    THEN eav.value END) AS course
+    FROM redcap.redcap_data AS eav
+    WHERE eav.project_id = :project_id_1
+      AND eav.field_name IN (:field_name_4, :field_name_5, :field_name_6)
+    GROUP BY eav.record
+    HAVING count(DISTINCT eav.field_name) = :count_1
     '''
     if not field_names:
         raise ValueError(field_names)
+    if aggregate is None:
+        aggregate = len(field_names) > PIVOT_JOIN_LIMIT
+    if aggregate:
+        eav = redcap_data.alias('eav')
+        cols = ([eav.c.record] if record else []) + [
+            func.max(case([(eav.c.field_name == n, eav.c.value)])).label(n)
+            for n in field_names]
+        return select(cols, and_(eav.c.project_id == project_id,
+                                 eav.c.field_name.in_(field_names)),
+                      from_obj=[eav]).group_by(eav.c.record).having(
+            func.count(distinct(eav.c.field_name)) == len(set(field_names)))
 
     froms = [(n, redcap_data.alias(n)) for n in field_names]
     cols = ([froms[0][1].c.record] if record else []) + [
@@ -3,6 +3,7 @@
 
 from collections import namedtuple
 import csv
+import itertools
 import logging
 import xml.etree.ElementTree as ET
 
@@ -14,10 +15,23 @@ def readRecords(fp):
 
     The header is used to define a namedtuple class.
     '''
+    return list(iterRecords(fp))
+
+
+def iterRecords(fp):
+    '''Read CSV into named tuples, one row at a time.
+
+    >>> from io import BytesIO
+    >>> rows = iterRecords(BytesIO(b'a,b\\n1,2\\n3,4\\n'))
+    >>> next(rows)
+    R(a='1', b='2')
+    >>> list(rows)
+    [R(a='3', b='4')]
+    '''
     reader = csv.reader(fp)
     header = reader.next()
     R = namedtuple('R', header)
-    return [R(*row) for row in reader]
+    return (R(*row) for row in reader)
 
 
 def docToRecords(relation_doc,
@@ -60,6 +74,61 @@ def docToRecords(relation_doc,
     return (record(child) for child in relation_doc)
 
 
+def streamRecords(fp, columns_of=None):
+    r'''Parse a record-oriented XML document incrementally, as with
+    :func:`docToRecords`, but without building the whole tree.
+
+    :param fp: a file-like object with the XML markup
+    :param columns_of: a function from record tag to column names;
+                       by default, those of the first record
+    :return: the tag of the records and an iterator over them;
+             each record's element is cleared once it is read.
+
+    >>> from io import BytesIO
+    >>> markup = b"""
+    ... <NewDataSet>
+    ...   <CRS><MemberID>123</MemberID><intScore>96</intScore></CRS>
+    ...   <CRS><intScore>91</intScore></CRS>
+    ... </NewDataSet>
+    ... """
+    >>> name, records = streamRecords(BytesIO(markup))
+    >>> name
+    'CRS'
+    >>> list(records)
+    [CRS(MemberID='123', intScore='96'), CRS(MemberID=None, intScore='91')]
+
+    >>> streamRecords(BytesIO(b'<doc/>'))
+    Traceback (most recent call last):
+      ...
+    StopIteration
+    '''
+    records = _iterRecords(fp, columns_of)
+    first = next(records)
+    return type(first).__name__, itertools.chain([first], records)
+
+
+def _iterRecords(fp, columns_of):
+    events = ET.iterparse(fp, events=('start', 'end'))
+    _, root = next(events)
+    depth, R, default = 0, None, None
+    for event, elt in events:
+        if event == 'start':
+            depth += 1
+            continue
+        depth -= 1
+        if depth != 0:  # a field, or the end of the document
+            continue
+        if R is None:
+            cols = (columns_of(elt.tag) if columns_of
+                    else [child.tag for child in elt])
+            R = namedtuple(elt.tag, cols)
+            default = R(*[None] * len(cols))
+        yield default._replace(**dict((child.tag, child.text)
+                                      for child in elt))
+        elt.clear()
+        root.clear()
+
+
 def mock_xml_records(template, qty):
     n = [10]
 